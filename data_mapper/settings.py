@@ -15,6 +15,7 @@ import os
 import dj_database_url
 from django.conf import settings
 from django.conf.urls.static import static
+from django.core.exceptions import ImproperlyConfigured
 
 from pathlib import Path
 
@@ -73,6 +74,8 @@ JSON_EDITOR_JS = 'https://cdnjs.cloudflare.com/ajax/libs/jsoneditor/8.6.4/jsoned
 JSON_EDITOR_CSS = 'https://cdnjs.cloudflare.com/ajax/libs/jsoneditor/8.6.4/jsoneditor.css'
 
 MIDDLEWARE = [
+    # First, so the time it reports covers the other middleware too
+    "mapper.profiling.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -126,10 +129,84 @@ DATABASES["default"] = dj_database_url.config(
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Largest file accepted by the mapper upload form. Large inputs are mapped chunk by chunk, so this mostly bounds disk use
+UPLOAD_MAX_FILE_SIZE = int(os.environ.get("UPLOAD_MAX_FILE_SIZE", 1024 * 1024 * 1024))
+# Total input size above which mapping runs chunk by chunk, and the memory a chunk of source rows may take
+STREAMING_THRESHOLD_BYTES = int(os.environ.get("STREAMING_THRESHOLD_BYTES", 64 * 1024 * 1024))
+STREAMING_CHUNK_MEMORY_BUDGET = int(os.environ.get("STREAMING_CHUNK_MEMORY_BUDGET", 64 * 1024 * 1024))
+# Frames longer than this are checked against the data quality schema on a random sample of this many rows
+VALIDATION_SAMPLE_ROWS = int(os.environ.get("VALIDATION_SAMPLE_ROWS", 1_000_000))
+# Example datasets above STREAMING_THRESHOLD_BYTES get their schema inferred chunk by chunk by this many processes
+# (0 for one per CPU), and their column descriptions generated from a random sample of this many rows
+SCHEMA_INFERENCE_WORKERS = int(os.environ.get("SCHEMA_INFERENCE_WORKERS", 0))
+SCHEMA_SAMPLE_ROWS = int(os.environ.get("SCHEMA_SAMPLE_ROWS", 10_000))
+# Columns with more distinct values than this, or whose values are nearly all distinct, aren't checked for categories
+CATEGORY_MAX_CARDINALITY = int(os.environ.get("CATEGORY_MAX_CARDINALITY", 50))
+CATEGORY_MAX_DISTINCT_RATIO = float(os.environ.get("CATEGORY_MAX_DISTINCT_RATIO", 0.9))
+# Parsed schemas kept in memory per process, least recently used dropped first
+SCHEMA_REGISTRY_SIZE = int(os.environ.get("SCHEMA_REGISTRY_SIZE", 256))
+
+# Generated pandas code runs in a pool of worker processes so that runaway code can't take the web worker down.
+# Each run gets a wall-clock timeout and a CPU time limit, each worker a memory limit on top of its idle footprint.
+SANDBOX_ENABLED = os.environ.get("SANDBOX_ENABLED", "true").lower() == "true"
+SANDBOX_WORKERS = int(os.environ.get("SANDBOX_WORKERS", 2))
+SANDBOX_TIMEOUT = float(os.environ.get("SANDBOX_TIMEOUT", 300))
+SANDBOX_CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", 300))
+SANDBOX_MEMORY_BYTES = int(os.environ.get("SANDBOX_MEMORY_BYTES", 2 * 1024 * 1024 * 1024))
+
+# Background jobs. A running job's worker bumps its heartbeat every JOB_HEARTBEAT_INTERVAL seconds; a job whose
+# heartbeat is older than JOB_STALE_AFTER seconds lost its worker and is queued again, or failed after JOB_MAX_ATTEMPTS
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", 30))
+JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
 # urlpatterns = [
 #     # ... the rest of your URLconf goes here ...
 # ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
+# LLM
+# Maximum number of concurrent requests made to the LLM provider when prompts are fanned out per column
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+# Prompt size, in tokens, of one batched code generation request (0 sends one request per column instead)
+LLM_BATCH_TOKEN_BUDGET = int(os.environ.get("LLM_BATCH_TOKEN_BUDGET", 2500))
+# Requests to the LLM provider in flight at once per process, over all fan-outs, and keep-alive connections kept open
+LLM_GLOBAL_CONCURRENCY = int(os.environ.get("LLM_GLOBAL_CONCURRENCY", 16))
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", LLM_GLOBAL_CONCURRENCY))
+# Seconds before a request is abandoned, attempts per call and longest wait between attempts
+LLM_REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", 60))
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", 6))
+LLM_RETRY_MAX_WAIT = float(os.environ.get("LLM_RETRY_MAX_WAIT", 60))
+# Base URL of a completions API to use instead of OpenAI's, e.g. the llm_stub_server command's http://localhost:8001/v1
+LLM_API_BASE = os.environ.get("LLM_API_BASE")
+# Dollars per 1000 prompt and per 1000 completion tokens of each model, for the llm_report command
+LLM_PRICES = {"gpt-3.5-turbo": (0.0015, 0.002)}
+
+# Persistent cache of LLM responses, shared between workers. On Heroku the responses are kept in MemCachier,
+# everywhere else in an on-disk SQLite cache that is evicted least-recently-used first.
+if "MEMCACHIER_SERVERS" in os.environ:
+    CACHES = {
+        "default": {
+            "BACKEND": "django_bmemcached.memcached.BMemcached",
+            "LOCATION": os.environ["MEMCACHIER_SERVERS"].split(","),
+            "OPTIONS": {
+                "username": os.environ.get("MEMCACHIER_USERNAME"),
+                "password": os.environ.get("MEMCACHIER_PASSWORD"),
+            },
+        }
+    }
+    LLM_CACHE = {
+        "BACKEND": "mapper.llm_cache.DjangoCacheBackend",
+        "ALIAS": "default",
+        "TIMEOUT": 60 * 60 * 24 * 30,
+    }
+else:
+    LLM_CACHE = {
+        "BACKEND": "mapper.llm_cache.DiskCacheBackend",
+        "LOCATION": os.environ.get("LLM_CACHE_DIR", os.path.join(BASE_DIR, ".llm_cache")),
+        "SIZE_LIMIT": 2 ** 30,
+        "TIMEOUT": 60 * 60 * 24 * 30,
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -169,7 +246,40 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
 STATIC_URL = "static/"
-STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+
+# Uploads, mapped frames and stored columns go through the default storage: local disk under MEDIA_ROOT, or an
+# S3-compatible bucket (AWS S3, MinIO, ...) when STORAGE_BUCKET_NAME is set, which requires django-storages and boto3
+if os.environ.get("STORAGE_BUCKET_NAME"):
+    try:
+        import boto3  # noqa: F401
+        import storages  # noqa: F401
+    except ImportError as e:
+        raise ImproperlyConfigured(f"STORAGE_BUCKET_NAME is set but {e.name} is not installed, install django-storages and boto3") from e
+    DEFAULT_STORAGE = {
+        "BACKEND": "storages.backends.s3boto3.S3Boto3Storage",
+        "OPTIONS": {
+            "bucket_name": os.environ["STORAGE_BUCKET_NAME"],
+            "endpoint_url": os.environ.get("STORAGE_ENDPOINT_URL"),
+            "access_key": os.environ.get("STORAGE_ACCESS_KEY"),
+            "secret_key": os.environ.get("STORAGE_SECRET_KEY"),
+            "file_overwrite": True,
+        },
+    }
+else:
+    DEFAULT_STORAGE = {"BACKEND": "django.core.files.storage.FileSystemStorage"}
+STORAGES = {
+    "default": DEFAULT_STORAGE,
+    "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+}
+# Mapped frames no pipeline run refers to any more are deleted once they are this old, stored columns and local copies of
+# stored files are deleted once they are this old, see the gc_artefacts command
+ARTEFACT_RETENTION_SECONDS = int(os.environ.get("ARTEFACT_RETENTION_SECONDS", 7 * 24 * 60 * 60))
+
+# Profiling, see mapper.profiling. Requests with an X-Profile header are run under cProfile when PROFILING_CPROFILE is
+# set, and tracing allocations makes stages report their peak memory at the cost of slowing every allocation down
+PROFILING_CPROFILE = os.environ.get("PROFILING_CPROFILE", str(DEBUG)).lower() == "true"
+PROFILING_TRACE_MEMORY = os.environ.get("PROFILING_TRACE_MEMORY", "false").lower() == "true"
+PROFILING_HISTORY_SIZE = int(os.environ.get("PROFILING_HISTORY_SIZE", 1000))
 STATIC_ROOT = BASE_DIR / "staticfiles"
 
 
@@ -0,0 +1,8 @@
+# Read by gunicorn from the working directory on startup
+
+
+def post_worker_init(worker):
+    # Parse the schemas in each worker before it serves its first request
+    from mapper.schema_registry import warm_schema_registry
+
+    warm_schema_registry()
@@ -1,3 +1,19 @@
 from django.contrib import admin
 
+from .models import LLMCall, PipelineRun
+
 # Register your models here.
+
+
+@admin.register(PipelineRun)
+class PipelineRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'schema', 'df_name', 'created_at', 'updated_at')
+    list_filter = ('schema',)
+    readonly_fields = ('created_at', 'updated_at')
+
+
+@admin.register(LLMCall)
+class LLMCallAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'function', 'column', 'schema', 'prompt_tokens', 'completion_tokens', 'latency', 'cache_hit')
+    list_filter = ('function', 'cache_hit', 'schema')
+    readonly_fields = ('created_at',)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MapperConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "mapper"
+
+    def ready(self):
+        # Connects the signals that drop parsed schemas when their row changes
+        from . import schema_registry  # noqa: F401
@@ -0,0 +1,54 @@
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+
+def _json_value(value: Any) -> Any:
+    # numpy scalars and timestamps aren't JSON serialisable, profiles may be stored
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value
+
+
+def profile_columns(df: pd.DataFrame, top_k: int = 10, sample_size: int = 20) -> dict[str, dict]:
+    """
+    Profile every column of df: dtype, number of values, null rate, number of distinct values, the top_k most
+    frequent values with their counts and a sample of distinct values.
+
+    The sample is stratified over the frequency ranking of the values, so it holds common values as well as rare
+    ones instead of only what happens to come first in the frame. Profiles are JSON serialisable.
+    """
+    null_counts = df.isna().sum()
+    profiles = {}
+    for column in df.columns:
+        value_counts = df[column].value_counts(dropna=True)
+        cardinality = len(value_counts)
+        if cardinality > sample_size:
+            positions = np.linspace(0, cardinality - 1, sample_size).round().astype(int)
+        else:
+            positions = np.arange(cardinality)
+        profiles[str(column)] = {
+            'dtype': str(df[column].dtype),
+            'count': int(len(df) - null_counts[column]),
+            'null_rate': float(null_counts[column] / len(df)) if len(df) else 0.0,
+            'cardinality': cardinality,
+            'top_values': [[_json_value(value), int(count)] for value, count in value_counts.head(top_k).items()],
+            'sample': [_json_value(value) for value in value_counts.index[positions]],
+        }
+    return profiles
+
+
+def format_profile(column: str, profile: dict) -> str:
+    """
+    Render a column profile compactly for a prompt.
+    """
+    top_values = ", ".join(f"{value!r} ({count})" for value, count in profile['top_values'])
+    return (
+        f"Column {column} ({profile['dtype']}): {profile['count']} values, {profile['null_rate']:.1%} missing, "
+        f"{profile['cardinality']} distinct.\n"
+        f"Most frequent values: {top_values}\n"
+        f"Sample of distinct values: {profile['sample']}"
+    )
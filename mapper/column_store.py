@@ -0,0 +1,154 @@
+import ast
+import hashlib
+import json
+import os
+import uuid
+from typing import Callable, Mapping, Optional
+
+import pandas as pd
+
+from .frames import FRAME_SUFFIX
+from .sandbox import run_code
+from .storage import exists, local_path, publish, working_path
+
+# Materialised output columns live under COLUMN_STORE_DIRECTORY of the default storage, one Parquet file per column
+# version
+COLUMN_STORE_DIRECTORY = 'columns'
+
+
+def column_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def source_identity(path: str) -> str:
+    # Changes whenever the file at path is replaced or rewritten
+    stat = os.stat(path)
+    return f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def column_name(key: str) -> str:
+    return f'{COLUMN_STORE_DIRECTORY}/{key}{FRAME_SUFFIX}'
+
+
+def load_column(key: str) -> Optional[pd.Series]:
+    name = column_name(key)
+    if not exists(name):
+        return None
+    return pd.read_parquet(local_path(name), engine='pyarrow').iloc[:, 0]
+
+
+def save_column(key: str, series: pd.Series) -> None:
+    name = column_name(key)
+    path = working_path(name)
+    # Written aside and moved in place, so concurrent runs never read a half-written column
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    series.to_frame().to_parquet(tmp_path, engine='pyarrow', index=True)
+    os.replace(tmp_path, path)
+    publish(name)
+
+
+def code_dependencies(code: str) -> tuple[set[str], Optional[set[str]]]:
+    """
+    The names code reads and the columns of df it reads. The columns are None when code uses df other than through
+    df['column'], it may then read any of them.
+    """
+    tree = ast.parse(code)
+    columns = set()
+    subscripted = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'df' \
+                and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            subscripted.add(id(node.value))
+            if isinstance(node.ctx, ast.Load):
+                columns.add(node.slice.value)
+        if isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Subscript) \
+                and isinstance(node.target.slice, ast.Constant):
+            # df['a'] += 1 reads df['a'] as well
+            columns.add(node.target.slice.value)
+
+    names = set()
+    whole_df = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+            if node.id == 'df' and id(node) not in subscripted:
+                whole_df = True
+    return names, None if whole_df else columns
+
+
+def source_columns(code: str, variable: str) -> Optional[set[str]]:
+    """
+    The columns of the frame variable that code reads, or None when it uses variable other than through
+    variable['column'] or variable[['column', ...]] and may read any of them.
+    """
+    tree = ast.parse(code)
+    columns = set()
+    subscripted = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == variable:
+            keys = node.slice.elts if isinstance(node.slice, ast.List) else [node.slice]
+            if all(isinstance(key, ast.Constant) and isinstance(key.value, str) for key in keys):
+                subscripted.add(id(node.value))
+                columns.update(key.value for key in keys)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == variable and id(node) not in subscripted:
+            return None
+    return columns
+
+
+def materialize_columns(column_code: Mapping[str, str], sources: Mapping[str, str], load_source: Callable[[str], pd.DataFrame], df: Optional[pd.DataFrame] = None, base_keys: Optional[Mapping[str, str]] = None) -> tuple[pd.DataFrame, dict[str, str]]:
+    """
+    Run column_code, the code assigning each column of df in order, recomputing only the columns whose result isn't
+    stored yet.
+
+    A column's result is stored under a key derived from its code, the identity of the sources it reads (from sources,
+    a mapping of variable name to identity) and the keys of the columns of df it reads, so editing a column's code
+    recomputes that column and the columns reading it only. load_source(variable) is only called for the sources of
+    recomputed columns. df is the frame the code starts from, whose columns have the keys in base_keys.
+
+    Returns the resulting frame and the key of each column in column_code.
+    """
+    keys = dict(base_keys or {})
+    plan = []
+    for column, code in column_code.items():
+        names, read_columns = code_dependencies(code)
+        if read_columns is None:
+            read_columns = set(keys)
+        key = column_key(
+            code,
+            {name: sources[name] for name in names if name in sources},
+            {read_column: keys.get(read_column) for read_column in read_columns},
+        )
+        keys[column] = key
+        plan.append((column, code, key, names, read_columns))
+
+    df = df.copy() if df is not None else pd.DataFrame()
+    loaded_sources = {}
+    index = 0
+    while index < len(plan):
+        column, code, key, names, read_columns = plan[index]
+        stored = load_column(key)
+        if stored is not None:
+            df[column] = stored
+            index += 1
+            continue
+
+        # Run this column and the stored-less columns right after it in one go, in order
+        group = [plan[index]]
+        while index + len(group) < len(plan) and not exists(column_name(plan[index + len(group)][2])):
+            group.append(plan[index + len(group)])
+        group_names = set().union(*(names for _, _, _, names, _ in group))
+        group_read_columns = set().union(*(read_columns for _, _, _, _, read_columns in group))
+        frames = {}
+        for name in group_names & set(sources):
+            if name not in loaded_sources:
+                loaded_sources[name] = load_source(name)
+            frames[name] = loaded_sources[name]
+        frames['df'] = df[[read_column for read_column in df.columns if read_column in group_read_columns]]
+        result = run_code("\n".join(group_code for _, group_code, _, _, _ in group), frames)
+        for group_column, _, group_key, _, _ in group:
+            df[group_column] = result[group_column]
+            save_column(group_key, result[group_column])
+        index += len(group)
+
+    return df, {column: keys[column] for column in column_code}
@@ -1,17 +1,39 @@
 import json
 
 from django import forms
+from django.conf import settings
 from multiupload.fields import MultiFileField
 
+from .ingestion import UnsupportedFormatError, check_supported
 from .models import Schema, UploadedFile
+from .uploads import ensure_metadata
+
+
+def _check_upload_format(uploaded) -> None:
+    # Rejected before the file is saved, rather than failing once a job reads it
+    uploaded.seek(0)
+    magic = uploaded.read(8)
+    uploaded.seek(0)
+    try:
+        check_supported(magic)
+    except UnsupportedFormatError as e:
+        raise forms.ValidationError(f'{uploaded.name}: {e}')
+
 
 class UploadFileForm(forms.Form):
-    files = MultiFileField(min_num=1, max_num=5, max_file_size=1024*1024*5)
+    files = MultiFileField(min_num=1, max_num=5, max_file_size=settings.UPLOAD_MAX_FILE_SIZE)
+
+    def clean_files(self):
+        files = self.cleaned_data['files']
+        for each in files:
+            _check_upload_format(each)
+        return files
 
     def save(self):
         uploaded_files = []
         for each in self.cleaned_data['files']:
             uploaded_file = UploadedFile.objects.create(file=each)
+            ensure_metadata(uploaded_file)
             uploaded_files.append(uploaded_file)
         return uploaded_files
 
@@ -21,9 +43,16 @@ class CreateSchemaForm(forms.Form):
     # description = forms.CharField(widget=forms.Textarea, required=False)
     example_dataset = forms.FileField()
 
+    def clean_example_dataset(self):
+        example_dataset = self.cleaned_data['example_dataset']
+        _check_upload_format(example_dataset)
+        return example_dataset
+
 class EditSchemaForm(forms.ModelForm):
     pandera_schema = forms.CharField(widget=forms.Textarea, label='Data Quality Schema')
     categories = forms.CharField(widget=forms.Textarea, label='Categories')
+    # The create_schema job the form was filled in by
+    job_id = forms.IntegerField(widget=forms.HiddenInput, required=False)
 
     class Meta:
         model = Schema
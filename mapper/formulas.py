@@ -0,0 +1,70 @@
+import ast
+import re
+from typing import Mapping, Optional
+
+import pandas as pd
+
+# A reference to a column of an uploaded file, as the mapping plan prompts write them: file1.name or file1.csv.name
+REFERENCE_RE = re.compile(r"(?<![\w.])(?P<file>\w+)(?:\.csv)?\.(?P<column>\w+)(?![\w.])")
+
+_ARITHMETIC_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.USub, ast.UAdd, ast.Name, ast.Constant, ast.Load)
+
+
+def _placeholder(index: int) -> str:
+    return f"__ref{index}__"
+
+
+def compile_formula(formula: str, frames: Mapping[str, pd.DataFrame]) -> Optional[str]:
+    """
+    Compile a simple mapping plan formula to a vectorised pandas expression over the file variables in frames.
+
+    Handles a single reference (file1.name), references separated by spaces, which are concatenated with a space
+    (file1.first_name file1.last_name) leaving out missing parts, missing altogether when every part is, and arithmetic on numeric columns and numbers (file1.foo + file2.bar * 2).
+    Returns None for anything else, including references to unknown files or columns, so the caller can fall back to
+    generating the code with the LLM.
+    """
+    formula = formula.strip()
+    formula = re.sub(r"^formula:", "", formula, flags=re.IGNORECASE).strip().strip("\"'`").strip()
+
+    references = []
+
+    def replace_reference(match):
+        # Files are bound to variables the same way helpers._file_variable names them
+        variable = f"{match['file']}_df"
+        if variable not in frames or match["column"] not in frames[variable].columns:
+            return match[0]
+        references.append((variable, match["column"]))
+        return _placeholder(len(references) - 1)
+
+    expression = REFERENCE_RE.sub(replace_reference, formula)
+    if not references:
+        return None
+    code = [f"{variable}[{column!r}]" for variable, column in references]
+
+    tokens = expression.split()
+    if tokens == [_placeholder(index) for index in range(len(references))]:
+        if len(code) == 1:
+            return code[0]
+        others = ", ".join(f"{series}.astype('string')" for series in code[1:])
+        # Without na_rep a single missing part, e.g. a missing last name, would make the whole value missing
+        return f"{code[0]}.astype('string').str.cat([{others}], sep=' ', na_rep='').str.strip().replace('', pd.NA)"
+
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError:
+        return None
+    for node in ast.walk(tree):
+        if not isinstance(node, _ARITHMETIC_NODES):
+            return None
+        if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or not isinstance(node.value, (int, float))):
+            return None
+        if isinstance(node, ast.Name) and not re.fullmatch(r"__ref\d+__", node.id):
+            return None
+    # Arithmetic on text would concatenate or fail, leave the intent of those to the LLM
+    for variable, column in references:
+        dtype = frames[variable][column].dtype
+        if not pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+            return None
+
+    # Plain pandas arithmetic, which pandas evaluates with numexpr on large frames
+    return re.sub(r"__ref(\d+)__", lambda match: code[int(match[1])], ast.unparse(tree))
@@ -0,0 +1,200 @@
+import io
+import os
+import re
+import uuid
+import zlib
+from typing import Iterable, Iterator, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import zstandard
+except ImportError:  # zstd downloads are only offered with zstandard installed
+    zstandard = None
+
+from .profiling import stage
+from .storage import publish, working_path
+
+# Intermediate frames are kept as Parquet so dtypes survive between steps and reads don't re-parse text
+FRAME_SUFFIX = '.parquet'
+# Rows per Parquet row group. A window of rows is read from the row groups covering it only, so this bounds the cost
+# of reading a page of a frame whatever the size of the frame
+FRAME_ROW_GROUP_SIZE = 64 * 1024
+# Compressions a frame can be downloaded with: file extension and content type of each
+DOWNLOAD_COMPRESSIONS = {
+    'gzip': ('.gz', 'application/gzip'),
+    **({'zstd': ('.zst', 'application/zstd')} if zstandard is not None else {}),
+}
+# Rows a FrameWriter holds back while some column has only been missing values so far, before it gives that column
+# a type anyway: the type of a Parquet column is fixed by the first row group written
+FRAME_SCHEMA_BUFFER_ROWS = 4 * FRAME_ROW_GROUP_SIZE
+# Mapped frames are kept under this directory of the default storage, by name rather than by local path, see storage
+FRAME_DIRECTORY = 'after_mapping'
+
+
+def new_frame_name(directory: str = FRAME_DIRECTORY) -> str:
+    return f'{directory}/{uuid.uuid4().hex}{FRAME_SUFFIX}'  # generate a unique filename
+
+
+def frame_id(name: str) -> str:
+    return os.path.basename(name).removesuffix(FRAME_SUFFIX)
+
+
+def frame_name(frame_id: str, directory: str = FRAME_DIRECTORY) -> str:
+    # Frame ids end up in URLs, so only accept the ids new_frame_name generates
+    if not re.fullmatch(r'[0-9a-f]{32}', frame_id):
+        raise ValueError(f'Invalid frame id {frame_id}')
+    return f'{directory}/{frame_id}{FRAME_SUFFIX}'
+
+
+def save_frame(df: pd.DataFrame, path: str) -> None:
+    df.to_parquet(path, engine='pyarrow', index=False, row_group_size=FRAME_ROW_GROUP_SIZE)
+
+
+def store_frame(df: pd.DataFrame, name: str) -> None:
+    save_frame(df, working_path(name))
+    publish(name)
+
+
+@stage('read_frame')
+def load_frame(path: str, columns: Optional[list[str]] = None, memory_map: bool = True) -> pd.DataFrame:
+    return pq.read_table(path, columns=columns, memory_map=memory_map).to_pandas()
+
+
+def count_frame_rows(path: str) -> int:
+    # Read from the Parquet footer, no data is loaded
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def load_frame_window(path: str, offset: int, limit: int) -> pd.DataFrame:
+    """
+    Load rows [offset, offset + limit) of the frame stored at path, reading only the row groups that hold them.
+    """
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    row_groups = []
+    window_start = None
+    row_group_start = 0
+    for index in range(parquet_file.num_row_groups):
+        row_group_rows = parquet_file.metadata.row_group(index).num_rows
+        if row_group_start + row_group_rows > offset and row_group_start < offset + limit:
+            if window_start is None:
+                window_start = row_group_start
+            row_groups.append(index)
+        row_group_start += row_group_rows
+
+    if not row_groups:
+        return parquet_file.schema_arrow.empty_table().to_pandas()
+    table = parquet_file.read_row_groups(row_groups).slice(offset - window_start, limit)
+    df = table.to_pandas()
+    df.index = pd.RangeIndex(offset, offset + len(df))
+    return df
+
+
+def _promote_types(types: list[pa.DataType]) -> pa.DataType:
+    # The narrowest type every value of a column fits in without loss: missing values fit in any type, integers and
+    # floats in floats, anything else in text
+    types = [data_type for data_type in types if not pa.types.is_null(data_type)]
+    if not types:
+        return pa.null()
+    if all(data_type == types[0] for data_type in types):
+        return types[0]
+    if all(pa.types.is_integer(data_type) for data_type in types):
+        return pa.int64()
+    if all(pa.types.is_integer(data_type) or pa.types.is_floating(data_type) for data_type in types):
+        return pa.float64()
+    return pa.string()
+
+
+def _unify_schemas(schemas: list[pa.Schema]) -> pa.Schema:
+    fields = [pa.field(name, _promote_types([schema.field(name).type for schema in schemas])) for name in schemas[0].names]
+    return pa.schema(fields, metadata=schemas[0].metadata)
+
+
+class FrameWriter:
+    """
+    Append frames with the same columns to a single Parquet file, one row group per frame.
+
+    The file's schema is resolved from the first frames rather than the first one only: while a column has only held
+    missing values, frames are held back, up to FRAME_SCHEMA_BUFFER_ROWS rows, so the column gets the type of its first
+    values. Integer columns that hold floats in another frame held back are written as floats; columns still without
+    values are written as text. Later frames are cast to the schema safely, a frame that doesn't fit it raises
+    ValueError rather than losing values.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer = None
+        self._pending = []
+
+    def write(self, df: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._writer is None:
+            self._pending.append(table)
+            schema = _unify_schemas([pending.schema for pending in self._pending])
+            if any(pa.types.is_null(field.type) for field in schema) and sum(pending.num_rows for pending in self._pending) < FRAME_SCHEMA_BUFFER_ROWS:
+                return
+            self._open(schema)
+        else:
+            self._write_table(table)
+
+    def _open(self, schema: pa.Schema) -> None:
+        schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema], metadata=schema.metadata)
+        self._writer = pq.ParquetWriter(self.path, schema)
+        pending, self._pending = self._pending, []
+        for table in pending:
+            self._write_table(table)
+
+    def _write_table(self, table: pa.Table) -> None:
+        schema = self._writer.schema
+        try:
+            table = table.select(schema.names).cast(schema, safe=True)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, KeyError) as e:
+            raise ValueError(f'Mapped rows don\'t fit the columns of the rows mapped before them: {e}') from e
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        if self._writer is None and self._pending:
+            self._open(_unify_schemas([pending.schema for pending in self._pending]))
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_frame_csv(path: str, batch_size: int = 64 * 1024) -> Iterator[str]:
+    """
+    Render the frame stored at path as CSV, batch by batch, without loading the whole frame into memory.
+    """
+    parquet_file = pq.ParquetFile(path)
+    yield pd.DataFrame(columns=parquet_file.schema_arrow.names).to_csv(index=False)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        buffer = io.StringIO()
+        batch.to_pandas().to_csv(buffer, index=False, header=False)
+        yield buffer.getvalue()
+
+
+def iter_compressed(chunks: Iterable[str], compression: Optional[str] = None) -> Iterator[bytes]:
+    """
+    Encode chunks of text and compress them on the fly with one of DOWNLOAD_COMPRESSIONS, or not at all.
+    """
+    if compression is None:
+        for chunk in chunks:
+            yield chunk.encode()
+        return
+    if compression == 'gzip':
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip header and trailer
+    elif compression in DOWNLOAD_COMPRESSIONS:
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError(f'Unknown compression {compression}')
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode())
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -1,18 +1,65 @@
+import ast
+import hashlib
 import json
-from typing import Mapping, Optional, Union
-
+import logging
+import os
+import time
+from concurrent.futures import as_completed
+from itertools import zip_longest
+from typing import Callable, Mapping, Optional, Union
+
+import numpy as np
 import pandas as pd
 import pandera as pa
 from django.conf import settings
-from langchain import LLMChain, OpenAI, PromptTemplate
+from django.core.cache import cache
+from langchain import PromptTemplate
 from pydantic import BaseModel
 from marvin import ai_fn, ai_model
+from marvin.ai_functions import data as marvin_data
 
 PARSED_FROM_UNSTRUCTURED_TEXT = "parsed_from_text"
 
 import langchain
-from langchain.cache import InMemoryCache
-langchain.llm_cache = InMemoryCache()
+import marvin
+from .column_profiles import format_profile, profile_columns
+from .column_store import column_key, load_column, materialize_columns, save_column, source_columns, source_identity
+from .formulas import compile_formula
+from .joins import align_sources, infer_join_plan, joined_source_loader, joined_variables
+from .frames import FrameWriter, save_frame
+from .llm_cache import cache_key, get_llm_cache
+from .llm_accounting import ContextThreadPoolExecutor, count_tokens, record_llm_call
+from .llm_gateway import call, get_llm
+from .models import CompiledPlan
+from .profiling import stage
+from .sandbox import run_code
+from .schema_inference import infer_file_schema
+from .ingestion import iter_chunks, read_table
+from .uploads import EXAMPLE_SAMPLE_ROWS, file_format, file_metadata, sample_frame
+langchain.llm_cache = get_llm_cache()
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of LLM requests we keep in flight at once when fanning out per-column prompts
+LLM_MAX_CONCURRENCY = getattr(settings, "LLM_MAX_CONCURRENCY", 8)
+# Prompt size, in tokens, of a batched code generation request. 0 generates code with one request per column
+LLM_BATCH_TOKEN_BUDGET = getattr(settings, "LLM_BATCH_TOKEN_BUDGET", 2500)
+
+# Number of mapped rows returned for the preview when the output is streamed to a file
+PREVIEW_ROWS = 100
+# Columns with more distinct values than this, or whose values are nearly all distinct, are not checked for categories
+CATEGORY_MAX_CARDINALITY = getattr(settings, "CATEGORY_MAX_CARDINALITY", 50)
+CATEGORY_MAX_DISTINCT_RATIO = getattr(settings, "CATEGORY_MAX_DISTINCT_RATIO", 0.9)
+# Frames longer than this are validated on a random sample of this many rows
+VALIDATION_SAMPLE_ROWS = getattr(settings, "VALIDATION_SAMPLE_ROWS", 1_000_000)
+# Total input size above which the mapping code is run chunk by chunk instead of on whole files
+STREAMING_THRESHOLD_BYTES = getattr(settings, "STREAMING_THRESHOLD_BYTES", 64 * 1024 ** 2)
+# Memory the source rows of one chunk may take up when streaming
+STREAMING_CHUNK_MEMORY_BUDGET = getattr(settings, "STREAMING_CHUNK_MEMORY_BUDGET", 64 * 1024 ** 2)
+# Processes inferring the schema of a large example dataset (0 for one per CPU), and rows its descriptions come from
+SCHEMA_INFERENCE_WORKERS = getattr(settings, "SCHEMA_INFERENCE_WORKERS", 0)
+SCHEMA_SAMPLE_ROWS = getattr(settings, "SCHEMA_SAMPLE_ROWS", 10_000)
+
 
 class FileFieldReference(BaseModel):
     """
@@ -90,22 +137,20 @@ class Categories(BaseModel):
         return json.dumps(self, default=lambda o: o.__dict__,
                           sort_keys=True, indent=4)
 
-def inital_data_mapping_plan(uploaded_files: list[str], description_dict: Mapping[str, str], categories_dict: Mapping[str, Union[str, list[str]]]) -> Mapping[str, str]:
-    # get the first three examples of each file and store them in a dict where the keys are the name of the files
-    # and the values are the first three examples of each file
-    examples = {}
-    for uploaded_file in uploaded_files:
-        df = pd.read_csv(uploaded_file)
-        file_name = uploaded_file.split("/")[-1]
-        examples[file_name] = df.head(3)
-
-    # convert this to a paragraph where the name of the file precedes the examples. Then we add a markdown table with
-    # the header and the first three examples of each file
+@stage("prompt_build")
+def _examples_str(uploaded_files: list[str]) -> str:
+    # A paragraph where the name of each file precedes a markdown table with the header and the first three examples
+    # of the file, taken from the metadata read at upload time
     examples_str = ""
-    for file_name, df in examples.items():
-        examples_str += f"{file_name}\n"
-        examples_str += df.to_markdown()
+    for uploaded_file in uploaded_files:
+        examples_str += f"{uploaded_file.split('/')[-1]}\n"
+        examples_str += file_metadata(uploaded_file)["markdown"]
         examples_str += "\n\n"
+    return examples_str
+
+
+def inital_data_mapping_plan(uploaded_files: list[str], description_dict: Mapping[str, str], categories_dict: Mapping[str, Union[str, list[str]]], on_field_planned: Optional[Callable[[str, str], None]] = None, max_concurrency: int = LLM_MAX_CONCURRENCY) -> Mapping[str, str]:
+    examples_str = _examples_str(uploaded_files)
 
     # print(examples_str)
 
@@ -144,10 +189,6 @@ def inital_data_mapping_plan(uploaded_files: list[str], description_dict: Mappin
     formula_prompt = PromptTemplate(template=formula_template, input_variables=["column", "description"])
     categories_prompt = PromptTemplate(template=categories_template, input_variables=["field", "description", "categories"])
 
-
-    llm = OpenAI(model_name="gpt-3.5-turbo", temperature=0.0)
-    formula_llm_chain = LLMChain(prompt=formula_prompt, llm=llm)
-    categories_llm_chain = LLMChain(prompt=categories_prompt, llm=llm)
     # # @ai_fn
     # def _get_column_parsing_plan_description(column_parsing_plan: ColumnParsingPlan) -> str:
     #     # """
@@ -173,15 +214,26 @@ def inital_data_mapping_plan(uploaded_files: list[str], description_dict: Mappin
     #     mapping_plan_description[field] = _get_column_parsing_plan_description(mapping_plan[field])
     #
     # return mapping_plan_description
-    mapping_plan = {}
-    for field, description in description_dict.items():
+    def _plan_field(field: str, description: str) -> str:
         if field in categories_dict:
             categories = categories_dict[field]
-            list_of_files = categories_llm_chain.run(field=field, description=description, categories=categories)
-            mapping_plan[field] = "Parsed from " + list_of_files
-        else:
-            mapping_plan[field] = formula_llm_chain.run(column=field, description=description)
-
+            list_of_files = _call_llm(categories_prompt.format(field=field, description=description, categories=categories), "plan_categories", field)
+            return "Parsed from " + list_of_files
+        return _call_llm(formula_prompt.format(column=field, description=description), "plan_formula", field)
+
+    # Plan all fields at once; on_field_planned is called from this thread as soon as each field's plan comes back so
+    # callers can publish partial plans while the rest are still in flight.
+    planned = {}
+    with ContextThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = {executor.submit(_plan_field, field, description): field for field, description in description_dict.items()}
+        for future in as_completed(futures):
+            field = futures[future]
+            planned[field] = future.result()
+            if on_field_planned is not None:
+                on_field_planned(field, planned[field])
+
+    # Keep the schema's field order regardless of the order the plans completed in
+    mapping_plan = {field: planned[field] for field in description_dict}
     return mapping_plan
 
 
@@ -205,90 +257,281 @@ def inital_data_mapping_plan(uploaded_files: list[str], description_dict: Mappin
     #
     # return output_dict
 
-llm = OpenAI(model_name="gpt-3.5-turbo", temperature=0.0)
+llm = get_llm()
 
-def generate_description_dict(df):
-    # Replace this with your actual implementation
-    # print("template", template)
-    description_dict = {}
-    categories_dict = {}
-    df_markdown = df.head(3).to_markdown()
-    for column in df.columns:
-        template = f"""This is a sample of my dataframe:
+
+def _call_llm(prompt: str, function: str, column: str = "") -> str:
+    # function and column say what the prompt is for in the LLM call records, see llm_accounting
+    started = time.perf_counter()
+    result = call(llm.generate, [prompt])
+    answer = result.generations[0][0].text
+    # langchain reports the provider's token usage, only when it sent the prompt
+    record_llm_call(function, prompt, answer, time.perf_counter() - started, cache_hit=not result.llm_output, column=column, model=llm.model_name)
+    return answer
+
+
+def _cached_ai_model(model_cls, context: str, column: str = ""):
+    """
+    Build a marvin ai_model from unstructured context, reusing the cached result for the same model and context.
+    """
+    started = time.perf_counter()
+    llm_cache = get_llm_cache()
+    key = cache_key(
+        f"{model_cls.__name__}\n{model_cls.schema_json()}\n{context}",
+        marvin.settings.openai_model_name,
+        marvin.settings.openai_model_temperature,
+    )
+    cached = llm_cache.get_json(key)
+    if cached is not None:
+        record_llm_call(model_cls.__name__, context, json.dumps(cached), time.perf_counter() - started, cache_hit=True, column=column, model=marvin.settings.openai_model_name)
+        return model_cls.parse_obj(cached)
+    instance = call(model_cls, context)
+    values = instance.dict()
+    # marvin adds its own instructions to the prompt, only the context is counted
+    record_llm_call(model_cls.__name__, context, json.dumps(values), time.perf_counter() - started, cache_hit=False, column=column, model=marvin.settings.openai_model_name)
+    # marvin swallows API errors and returns an empty model, which must not be cached
+    if any(value is not None for value in values.values()):
+        llm_cache.set_json(key, values)
+    return instance
+
+
+def _describe_column(df_markdown: str, column: str) -> str:
+    template = f"""This is a sample of my dataframe:
                     {df_markdown}
 
                 Write a succinct description of the column {column}. Don't include superfluous information. Don't mention any reference to the dataframe or dataset.
                 Answer: The column {column} 
             """
-        description_dict[column] = llm(template)
-        # llm_chain = LLMChain(prompt=PromptTemplate(template=template), llm=llm)
-        template = f"""
-            These are the values of a column in my dataframe:
-            {df[column]}
+    return _call_llm(template, "describe_column", column)
+
+
+def _has_categories(column_profile: str, column: str = "") -> bool:
+    template = f"""
+        This is a profile of a column in my dataframe:
+        {column_profile}
+        
+        Are there categories in this data as it is? Answer with "yes" or "no".  
+        
+        Example 1: 
+            Question: ['Clarence', 'Erika', 'Juan', 'Terry', 'Joyce', 'Hilary']
+            Answer: no. Given the context, these are names of people and not categories.
             
-            Are there categories in this data as it is? Answer with "yes" or "no".  
-            
-            Example 1: 
-                Question: ['Clarence', 'Erika', 'Juan', 'Terry', 'Joyce', 'Hilary']
-                Answer: no. Given the context, these are names of people and not categories.
-                
-                Question: ['05/17/1964', '05/17/2014', '05/17/2003', '05/17/1925', '05/17/1954', '05/17/1986', '05/17/1936']
-                Answer: no. These are specific dates and there are no categories in this data as it is.
-            
-            Answer: 
-        """
-        answer = llm(template)
-        if not answer.lower().startswith('no'):
-            categories = Categories(f"{df[column]}")
-            if categories.categories:
-                categories = (list(map(lambda x: x.value, categories.categories)))
-                categories_dict[column] = categories
-        # categories_dict[column] = Categories(f"{df[column]}")
-        # description_dict[column] = ", ".join(list(map(lambda x: x.name, categories_dict[column].categories)))
-
-        # description_dict[column] = llm(template)
-
-    # description_dict = {column: "Description for " + column for column in df.columns}
+            Question: ['05/17/1964', '05/17/2014', '05/17/2003', '05/17/1925', '05/17/1954', '05/17/1986', '05/17/1936']
+            Answer: no. These are specific dates and there are no categories in this data as it is.
+        
+        Answer: 
+    """
+    answer = _call_llm(template, "has_categories", column)
+    return not answer.lower().startswith('no')
+
+
+def _obviously_categorical(profile: dict) -> Optional[bool]:
+    # Answer locally when the profile settles the question, None means the LLM has to look at the values
+    if profile["cardinality"] == 0 or profile["cardinality"] > CATEGORY_MAX_CARDINALITY:
+        return False
+    if profile["count"] >= 20 and profile["cardinality"] > CATEGORY_MAX_DISTINCT_RATIO * profile["count"]:
+        return False
+    if profile["dtype"] == "bool":
+        return True
+    return None
+
+
+def _detect_categories(column: str, profile: dict) -> Optional[list[str]]:
+    column_profile = format_profile(column, profile)
+    categorical = _obviously_categorical(profile)
+    if categorical is False:
+        return None
+    if categorical is None and not _has_categories(column_profile, column):
+        return None
+    categories = _cached_ai_model(Categories, column_profile, column)
+    if not categories.categories:
+        return None
+    return list(map(lambda x: x.value, categories.categories))
+
+
+def generate_description_dict(df, max_concurrency: int = LLM_MAX_CONCURRENCY):
+    """
+    Describe every column of df and detect the ones holding categories.
+
+    The description and categorisation prompts of all columns are sent together through a thread pool of at most
+    max_concurrency workers. Pass max_concurrency=1 to run them one after another. Categorisation prompts show a
+    profile of the column rather than its values, see profile_columns.
+    """
+    with stage("prompt_build"):
+        df_markdown = df.head(3).to_markdown()
+        profiles = profile_columns(df)
+    with ContextThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        descriptions = {column: executor.submit(_describe_column, df_markdown, column) for column in df.columns}
+        categories = {column: executor.submit(_detect_categories, column, profiles[str(column)]) for column in df.columns}
+
+        description_dict = {column: future.result() for column, future in descriptions.items()}
+        categories_dict = {}
+        for column, future in categories.items():
+            column_categories = future.result()
+            if column_categories:
+                categories_dict[column] = column_categories
+
     return description_dict, categories_dict
 
 def generate_pandera_schema(df):
     # Replace this with your actual implementation
-    pandera_schema = pa.infer_schema(df).to_json()
+    schema = pa.infer_schema(df)
+    with stage("to_json"):
+        pandera_schema = schema.to_json()
     return pandera_schema
 
-def execute_mapping_plan(files: list[str], mapping_plan: Mapping[str, str], description_dict: Mapping[str, str], categories_dict: Mapping[str, Union[str, list[str]]]) -> pd.DataFrame:
+def generate_pandera_schema_from_file(path: str) -> tuple[str, pd.DataFrame]:
+    """
+    Infer the pandera schema of the CSV file at path. Returns it as JSON, along with the frame to describe the columns
+    from: the whole file when it's small, a random sample of SCHEMA_SAMPLE_ROWS rows when it's larger than
+    STREAMING_THRESHOLD_BYTES, whose schema is then inferred chunk by chunk without loading it.
+    """
+    if os.path.getsize(path) <= STREAMING_THRESHOLD_BYTES:
+        df = read_table(path, file_format(path))
+        return generate_pandera_schema(df), df
+    schema, sample = infer_file_schema(path, sample_size=SCHEMA_SAMPLE_ROWS, max_workers=SCHEMA_INFERENCE_WORKERS or None, file_format=file_format(path))
+    with stage("to_json"):
+        return schema.to_json(), sample
 
-    examples = {}
-    df = pd.DataFrame()
-    code_to_exec = [
-        "df = pd.DataFrame()",
-    ]
+def _file_variable(uploaded_file: str) -> str:
+    # You can refer to a file by file_name_df in the generated code
+    return uploaded_file.split("/")[-1].split(".")[0] + "_df"
+
+
+def plan_file_join(files: list[str]) -> Optional[dict]:
+    """
+    Infer how to join the files on their key columns, see infer_join_plan. None for a single file, or when the files
+    share no key.
+    """
+    return infer_join_plan(
+        {_file_variable(uploaded_file): uploaded_file for uploaded_file in files},
+        {_file_variable(uploaded_file): file_format(uploaded_file) for uploaded_file in files},
+    )
+
+
+def _source_usecols(files: list[str], mapping_code: str, join_plan: Optional[Mapping] = None) -> dict[str, Optional[list[str]]]:
+    # The columns of each file the mapping code and the join read, in file order. None when it may read any column
+    usecols = {}
     for uploaded_file in files:
-        df = pd.read_csv(uploaded_file)
-        file_name = uploaded_file.split("/")[-1]
-        examples[file_name] = df.head(3)
-        file_name_df = file_name.split(".")[0] + "_df"
-        code_to_exec.append(f"{file_name_df} = pd.read_csv('{uploaded_file}')")
+        variable = _file_variable(uploaded_file)
+        columns = source_columns(mapping_code, variable)
+        if columns is not None and join_plan is not None:
+            columns |= {step["left_column"] for step in join_plan["steps"] if step["left"] == variable}
+            columns |= {step["right_column"] for step in join_plan["steps"] if step["right"] == variable}
+        usecols[variable] = None if columns is None else [column for column in file_metadata(uploaded_file)["header"] if column in columns]
+    return usecols
 
-    inital_code_to_exec = "\n".join(code_to_exec)
 
-    # convert this to a paragraph where the name of the file precedes the examples. Then we add a markdown table with
-    # the header and the first three examples of each file
-    examples_str = ""
-    for file_name, df in examples.items():
-        examples_str += f"{file_name}\n"
-        examples_str += df.to_markdown()
-        examples_str += "\n\n"
+def files_fingerprint(frames: Mapping[str, pd.DataFrame], join_plan: Optional[Mapping] = None) -> str:
+    """
+    Fingerprint of the input files: the variable each file is bound to in the generated code, its column names and
+    dtypes, and how the files are joined, see plan_file_join. Files with the same fingerprint can be mapped with the
+    same generated code.
+    """
+    signature = sorted(
+        [variable, [[str(column), str(dtype)] for column, dtype in df.dtypes.items()]]
+        for variable, df in frames.items()
+    )
+    if join_plan is not None:
+        # Code generated for joined files relies on their rows being matched, see align_sources
+        signature.append(["join_plan", join_plan])
+    return hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+
+
+# Bump this whenever the shape of the generated mapping code changes, so plans compiled before aren't reused
+MAPPING_CODE_VERSION = 4
+
+
+def mapping_plan_hash(mapping_plan: Mapping[str, str]) -> str:
+    # Every field and the text of its plan: code generated for a plan the user corrected isn't reused
+    return hashlib.sha256(json.dumps([MAPPING_CODE_VERSION, mapping_plan], sort_keys=True).encode()).hexdigest()
+
+
+def _batch_by_token_budget(batch_prompt: str, column_requests: Mapping[str, str], batch_token_budget: int) -> list[dict[str, str]]:
+    # Fill each batch with as many columns as fit in the budget next to the shared part of the prompt
+    budget = batch_token_budget - count_tokens(batch_prompt)
+    batches = []
+    batch = {}
+    batch_tokens = 0
+    for column, request in column_requests.items():
+        tokens = count_tokens(request)
+        if batch and batch_tokens + tokens > budget:
+            batches.append(batch)
+            batch = {}
+            batch_tokens = 0
+        batch[column] = request
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _generate_code_batch(batch_prompt: str, batch: Mapping[str, str], function: str) -> dict[str, str]:
+    template = batch_prompt + "\n".join(f"- {request}" for request in batch.values()) + """
+                
+                Answer with a JSON object where the keys are the column names and the values are the single-line of code for that column.
+                Answer: """
+    answer = _call_llm(template, f"{function}_batch", ", ".join(map(str, batch)))
+    try:
+        parsed = json.loads(answer[answer.index("{"):answer.rindex("}") + 1])
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    return {column: parsed[column] for column in batch if isinstance(parsed.get(column), str)}
 
 
+def _is_valid_column_code(code: Optional[str]) -> bool:
+    if not code or "\n" in code.strip():
+        return False
+    try:
+        return len(ast.parse(code.strip()).body) == 1
+    except SyntaxError:
+        return False
 
-    for column, formula in mapping_plan.items():
-        # if column in categories_dict:
-        #     continue
-        # here we have to convert the
-        # if column in categories_dict:
-        #     mapping_plan[column][0] = mapping_plan[column][0].removeprefix("Parsed from ")
-        template = f"""These are the files I have:
+
+def generate_column_code(batch_prompt: str, column_requests: Mapping[str, str], single_prompt: Callable[[str], str], batch_token_budget: int = LLM_BATCH_TOKEN_BUDGET, max_concurrency: int = LLM_MAX_CONCURRENCY, function: str = "column_code") -> dict[str, str]:
+    """
+    Generate a single line of code for every column in column_requests.
+
+    The columns are sent in as few requests as fit in batch_token_budget, each one asking for a JSON object of column
+    to code. Columns missing from the answers or whose code doesn't parse are generated again with their own
+    single_prompt(column).
+
+    The code of each column is cached under batch_prompt, the column and its request, so when a single request
+    changes only that column is generated again. Calls are recorded under function, see llm_accounting.
+    """
+    llm_cache = get_llm_cache()
+    keys = {
+        column: cache_key(json.dumps(["column_code", batch_prompt, column, request]), llm.model_name, llm.model_kwargs.get("temperature"))
+        for column, request in column_requests.items()
+    }
+    column_code = {}
+    for column, key in keys.items():
+        code = llm_cache.get_json(key)
+        if code is not None:
+            column_code[column] = code
+            record_llm_call(function, single_prompt(column), code, 0.0, cache_hit=True, column=column, model=llm.model_name)
+    uncached_requests = {column: request for column, request in column_requests.items() if column not in column_code}
+
+    with ContextThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        if batch_token_budget and uncached_requests:
+            batches = _batch_by_token_budget(batch_prompt, uncached_requests, batch_token_budget)
+            for batch_code in executor.map(lambda batch: _generate_code_batch(batch_prompt, batch, function), batches):
+                column_code.update({column: code.strip() for column, code in batch_code.items() if _is_valid_column_code(code)})
+
+        missing = [column for column in uncached_requests if column not in column_code]
+        for column, code in zip(missing, executor.map(lambda column: _call_llm(single_prompt(column), function, column), missing)):
+            column_code[column] = code
+
+    for column in uncached_requests:
+        if _is_valid_column_code(column_code[column]):
+            llm_cache.set_json(keys[column], column_code[column].strip())
+    return column_code
+
+
+def _column_code_prompt(examples_str: str, inital_code_to_exec: str, column: str, formula: str) -> str:
+    return f"""These are the files I have:
                 {examples_str}
                 
                 Write a single-line of code to parse the column `{column}` from the files. Don't write the entire parsing plan, just the code to parse the column.
@@ -300,7 +543,7 @@ def execute_mapping_plan(files: list[str], mapping_plan: Mapping[str, str], desc
                 This is the existing code:
                 {inital_code_to_exec}
                 
-                The formula to parse the column `{column}` is: {mapping_plan[column]}
+                The formula to parse the column `{column}` is: {formula}
                 
                 Example: 
                     Question: The formula to parse the column abcd is: file1.foo + file2.bar
@@ -308,78 +551,328 @@ def execute_mapping_plan(files: list[str], mapping_plan: Mapping[str, str], desc
                 
                 Answer: The single-line of code to parse the column `{column}` is:
             """
-        code_to_exec.append(llm(template))
 
-    code_to_exec.append("from marvin.ai_functions.data import map_categories, categorize")
-    for column, categories in categories_dict.items():
-        # template = f"""These are the files I have:
-        #                 {examples_str}
-        #
-        #                 Write a single-line of code to parse the column {column} from the files. Don't write the entire parsing plan, just the code to parse the column.
-        #                 You can refer to a file by file_name_df. For example, if the file is named 'my_file.csv', you can refer to it as 'my_file_df'.
-        #                 Assume we have a target dataframe called df.
-        #
-        #                 The formula to parse the column {column} is: {column_to_parse_formula}
-        #
-        #                 Example:
-        #                     Question: The formula to parse the column abcd is: file1.foo + file2.bar
-        #                     Answer: df['abcd'] = file1_df['foo'] + file2_df['bar']
-        #
-        #                 Answer: The single-line of code to parse the column {column} is:
-        #             """
-        # code_to_exec.append(llm(template))
-        if isinstance(categories, str):
-            code_to_exec.append(f"df['{column}'] = categorize(df['{column}'], description='{categories}')")
-        else:
-            code_to_exec.append(f"df['{column}'] = map_categories(df['{column}'], categories={categories})")
 
-    code_to_exec = "\n".join(code_to_exec)
-    print(code_to_exec)
+def _batched_column_code_prompt(examples_str: str, inital_code_to_exec: str) -> str:
+    return f"""These are the files I have:
+                {examples_str}
+                
+                Write a single-line of code to parse each of the columns listed below from the files. Don't write the entire parsing plan, just the code to parse each column.
+                You can refer to a file by file_name_df. For example, if the file is named 'my_file.csv', you can refer to it as 'my_file_df'.
+                Assume we have a target dataframe called df.
+                
+                No column should start with the words "Parsed from". Neither should the name of the file be mentioned in the name of the column.
+                
+                This is the existing code:
+                {inital_code_to_exec}
+                
+                Example: 
+                    Question: The formula to parse the column abcd is: file1.foo + file2.bar
+                    Answer: {{"abcd": "df['abcd'] = file1_df['foo'] + file2_df['bar']"}}
+                
+                The formulas to parse the columns are:
+            """
+
 
-    exec(code_to_exec)
+def generate_mapping_code(examples_str: str, inital_code_to_exec: str, mapping_plan: Mapping[str, str], batch_token_budget: int = LLM_BATCH_TOKEN_BUDGET, frames: Optional[Mapping[str, pd.DataFrame]] = None) -> dict[str, str]:
+    # Simple formulas over the columns of frames are compiled locally, only the others are sent to the LLM
+    column_code = {}
+    for column, formula in mapping_plan.items():
+        expression = compile_formula(formula, frames or {})
+        if expression is not None:
+            column_code[column] = f"df['{column}'] = {expression}"
+
+    llm_plan = {column: formula for column, formula in mapping_plan.items() if column not in column_code}
+    if llm_plan:
+        column_code.update(generate_column_code(
+            _batched_column_code_prompt(examples_str, inital_code_to_exec),
+            {column: f"The formula to parse the column `{column}` is: {formula}" for column, formula in llm_plan.items()},
+            lambda column: _column_code_prompt(examples_str, inital_code_to_exec, column, llm_plan[column]),
+            batch_token_budget=batch_token_budget,
+        ))
+    return {column: column_code[column] for column in mapping_plan}
+
+
+def _categorize_batch(values: list[str], categories: Union[str, list[str]], column: str = "") -> dict[str, str]:
+    started = time.perf_counter()
+    if isinstance(categories, str):
+        labels = call(marvin_data.categorize, data=values, description=categories)
+    else:
+        labels = call(marvin_data.map_categories, data=values, categories=categories)
+    record_llm_call("categorize", json.dumps([categories, values]), json.dumps(labels, default=str), time.perf_counter() - started, cache_hit=False, column=column, model=marvin.settings.openai_model_name)
+    if not isinstance(labels, list) or len(labels) != len(values):
+        return {}
+    return {value: label for value, label in zip(values, labels) if isinstance(label, str)}
+
+
+def categorize_series(series: pd.Series, categories: Union[str, list[str]], cache_namespace: str, batch_token_budget: int = LLM_BATCH_TOKEN_BUDGET, max_concurrency: int = LLM_MAX_CONCURRENCY) -> pd.Series:
+    """
+    Assign every value of series to one of categories, a list of categories or a description of them.
+
+    Only the distinct values are sent to the LLM, in batches of at most batch_token_budget tokens, and the category of
+    each value is cached persistently under cache_namespace and the categories, so later runs only ask for values they
+    have never seen. Missing values stay missing.
+    """
+    codes, uniques = pd.factorize(series)
+    values = [str(value) for value in uniques]
+    llm_cache = get_llm_cache()
+    keys = {
+        value: cache_key(
+            json.dumps(["categorize", cache_namespace, categories, value]),
+            marvin.settings.openai_model_name,
+            marvin.settings.openai_model_temperature,
+        )
+        for value in values
+    }
+    labels = {value: llm_cache.get_json(key) for value, key in keys.items()}
+
+    missing = [value for value, label in labels.items() if label is None]
+    if missing:
+        batches = _batch_by_token_budget(json.dumps(categories), {value: value for value in missing}, batch_token_budget)
+        with ContextThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            for batch_labels in executor.map(lambda batch: _categorize_batch(list(batch), categories, series.name), batches):
+                labels.update(batch_labels)
+            # Values the model skipped or answered out of order in their batch are asked for one by one
+            retry = [value for value in missing if labels[value] is None]
+            for batch_labels in executor.map(lambda value: _categorize_batch([value], categories, series.name), retry):
+                labels.update(batch_labels)
+        for value in missing:
+            if labels[value] is not None:
+                llm_cache.set_json(keys[value], labels[value])
+
+    # Missing values are coded -1 by factorize, which take reads from the trailing None
+    categorized = np.array([labels[value] for value in values] + [None], dtype=object)
+    return pd.Series(categorized.take(codes), index=series.index, name=series.name)
+
+
+def categorize_columns(df: pd.DataFrame, categories_dict: Mapping[str, Union[str, list[str]]], schema_id: Optional[int] = None, column_keys: Optional[Mapping[str, str]] = None) -> pd.DataFrame:
+    """
+    Categorise the columns of df listed in categories_dict. Given the column store keys of the uncategorised columns,
+    categorised columns are stored as well and reused while neither the column nor its categories change.
+    """
+    for column, categories in categories_dict.items():
+        if column not in df.columns:
+            continue
+        key = column_key("categorize", column_keys[column], categories) if column_keys else None
+        categorized = load_column(key) if key else None
+        if categorized is None:
+            categorized = categorize_series(df[column], categories, cache_namespace=f"{schema_id}/{column}")
+            if key:
+                save_column(key, categorized)
+        df[column] = categorized
+    return df
 
 
+def _chunksize_for_memory_budget(files: list[str], memory_budget: int) -> int:
+    # Estimate how much memory a row of all the files takes together from the sample read at upload time
+    bytes_per_row = sum(file_metadata(uploaded_file)["bytes_per_row"] for uploaded_file in files)
+    if not bytes_per_row:
+        return EXAMPLE_SAMPLE_ROWS
+    return max(1, int(memory_budget // bytes_per_row))
 
 
+def run_mapping_code_chunked(files: list[str], mapping_code: str, output_path: str, memory_budget: int = STREAMING_CHUNK_MEMORY_BUDGET, preview_rows: int = PREVIEW_ROWS, transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None, join_plan: Optional[Mapping] = None) -> pd.DataFrame:
+    """
+    Run the mapping code over the files chunk by chunk and append each mapped chunk to the frame stored at
+    output_path, so memory stays within memory_budget whatever the size of the files. Returns the first preview_rows
+    mapped rows. transform, if given, is applied to every mapped chunk before it is written.
 
+    The n-th chunks of all files are mapped together, so columns combining several files are only correct when the
+    files are row-aligned. Expressions that aggregate over a whole column only see one chunk at a time.
 
+    With a join_plan, only its base file is read chunk by chunk. The files joined to it are read whole, once, and each
+    chunk of the base file is joined to them.
+    """
+    variables = [_file_variable(uploaded_file) for uploaded_file in files]
+    # Only the columns the code reads are parsed
+    usecols = _source_usecols(files, mapping_code, join_plan)
+    lookups = {}
+    if join_plan is not None:
+        joined = set(joined_variables(join_plan)) - {join_plan["base"]}
+        lookups = {
+            variable: read_table(uploaded_file, file_format(uploaded_file), usecols=usecols[variable])
+            for variable, uploaded_file in zip(variables, files) if variable in joined
+        }
+        files = [uploaded_file for variable, uploaded_file in zip(variables, files) if variable not in joined]
+        variables = [variable for variable in variables if variable not in joined]
+    chunksize = _chunksize_for_memory_budget(files, memory_budget)
+    headers = [
+        sample_frame(file_metadata(uploaded_file)).loc[:, usecols[variable]] if usecols[variable] is not None else sample_frame(file_metadata(uploaded_file))
+        for variable, uploaded_file in zip(variables, files)
+    ]
+    readers = [iter_chunks(uploaded_file, chunksize, file_format(uploaded_file), usecols=usecols[variable]) for variable, uploaded_file in zip(variables, files)]
+    # Fail on syntax errors before the first chunk is read
+    compile(mapping_code, "<mapping_code>", "exec")
+
+    preview = None
+    with FrameWriter(output_path) as writer:
+        for chunks in zip_longest(*readers):
+            frames = {"df": pd.DataFrame()}
+            for variable, header, chunk in zip(variables, headers, chunks):
+                # A file that ran out of rows contributes missing values for the rest of the output
+                frames[variable] = chunk if chunk is not None else header
+            if join_plan is not None:
+                frames = align_sources({**frames, **lookups}, join_plan)
+            df = run_code(mapping_code, frames)
+            if transform is not None:
+                df = transform(df)
+            writer.write(df)
+            if preview is None:
+                preview = df.head(preview_rows)
+
+    for reader in readers:
+        reader.close()
+    return preview if preview is not None else pd.DataFrame()
+
+
+def execute_mapping_plan(files: list[str], mapping_plan: Mapping[str, str], description_dict: Mapping[str, str], categories_dict: Mapping[str, Union[str, list[str]]], schema_id: Optional[int] = None, output_path: Optional[str] = None, on_code_generated: Optional[Callable[[dict[str, str]], None]] = None, join_plan: Optional[Mapping] = None) -> pd.DataFrame:
+    """
+    Map the files to the schema following mapping_plan.
 
+    With a join_plan, see plan_file_join, the files it joins are hash joined once before the mapping code runs, so
+    their rows are matched by key rather than by position.
 
-    # template = f"""This is a sample of my dataframe:
-    #                     {df_markdown}
-    #
-    #                 Write a succinct description of the column {column} in active voice.
-    #                 Answer:
-    #             """
-    # # llm_chain = LLMChain(prompt=PromptTemplate(template=template), llm=llm)
-    # description_dict[column] = llm(template)
-    #
-    # df = pd.concat([pd.read_csv(file) for file in files])
-    return df
+    When schema_id is given, the generated code is stored as a CompiledPlan once it ran successfully, and later runs
+    with the same schema, mapping plan, input file columns and join plan reuse it instead of asking the LLM again.
 
-def run_data_quality_checks(df: pd.DataFrame, schema: pa.DataFrameSchema) -> Mapping[str, str]:
-    # Replace this with your actual implementation
-    # errors = {column: "Error for " + column for column in df.columns}
-    # return errors
-    try:
-        schema.validate(df)
-    except pa.errors.SchemaError as e:
-        errors = {column: str(e) for column in df.columns}
-        return errors
-    return {}
+    When output_path is given the mapped frame is also stored there. Inputs larger than
+    STREAMING_THRESHOLD_BYTES are then mapped chunk by chunk straight into the file, and only the first PREVIEW_ROWS
+    rows are returned. Otherwise every mapped column is kept in the column store, and a run only computes the columns
+    whose code or source files changed since an earlier run, see materialize_columns.
 
-def apply_transformations_to_df(orig_df: pd.DataFrame, transformations: Mapping[str, str]) -> pd.DataFrame:
-    # Replace this with your actual implementation
-    df = pd.DataFrame()
+    The columns in categories_dict are categorised after the mapping code ran, see categorize_series.
+    on_code_generated is called with the code of each column, generated or reused, before it runs.
+    """
+    frames = {}
     code_to_exec = [
         "df = pd.DataFrame()",
-        "df = orig_df"
     ]
-    example_df = orig_df.head(3).to_markdown()
-    for column, formula in transformations.items():
-        if not formula:
-            continue
-        template = f"""This is a sample of my dataframe:
+    for uploaded_file in files:
+        # The columns and dtypes read at upload time are enough to compile simple formulas and fingerprint the files,
+        # the generated code reads the whole file
+        file_name_df = _file_variable(uploaded_file)
+        frames[file_name_df] = sample_frame(file_metadata(uploaded_file))
+        code_to_exec.append(f"{file_name_df} = pd.read_csv('{uploaded_file}')")
+    if join_plan is not None:
+        for step in join_plan["steps"]:
+            code_to_exec.append(
+                f"# The rows of {step['right']} are already matched to those of {step['left']}, on "
+                f"{step['right']}['{step['right_column']}'] == {step['left']}['{step['left_column']}']: don't merge them"
+            )
+
+    inital_code_to_exec = "\n".join(code_to_exec)
+
+    compiled_plan = None
+    if schema_id is not None:
+        plan_hash = mapping_plan_hash(mapping_plan)
+        fingerprint = files_fingerprint(frames, join_plan)
+        compiled_plan = CompiledPlan.objects.filter(schema_id=schema_id, plan_hash=plan_hash, files_fingerprint=fingerprint).first()
+
+    if compiled_plan is not None:
+        column_code = json.loads(compiled_plan.code)
+    else:
+        column_code = generate_mapping_code(_examples_str(files), inital_code_to_exec, mapping_plan, frames=frames)
+    mapping_code = "\n".join(column_code.values())
+    # Fail before running anything if the LLM wrote something that isn't python
+    ast.parse(mapping_code)
+    if on_code_generated is not None:
+        on_code_generated(column_code)
+    logger.debug("Mapping code:\n%s", mapping_code)
+
+    if output_path is not None and sum(os.path.getsize(uploaded_file) for uploaded_file in files) > STREAMING_THRESHOLD_BYTES:
+        df = run_mapping_code_chunked(
+            files, mapping_code, output_path, transform=lambda chunk: categorize_columns(chunk, categories_dict, schema_id), join_plan=join_plan
+        )
+    else:
+        # Only the columns whose code or source files changed since the last run are computed again
+        paths = {_file_variable(uploaded_file): uploaded_file for uploaded_file in files}
+        sources = {variable: source_identity(path) for variable, path in paths.items()}
+        # Files are parsed once per run by the multithreaded pyarrow engine, only the columns the code reads
+        usecols = _source_usecols(files, mapping_code, join_plan)
+        load_source = lambda variable: read_table(paths[variable], file_format(paths[variable]), usecols=usecols[variable])
+        if join_plan is not None:
+            # A joined source changes with any of the files it is joined with, or with the way they are joined
+            joined_identity = column_key(join_plan, [sources[variable] for variable in joined_variables(join_plan)])
+            sources.update({variable: joined_identity for variable in joined_variables(join_plan)})
+            load_source = joined_source_loader(load_source, join_plan)
+        df, column_keys = materialize_columns(column_code, sources, load_source)
+        df = categorize_columns(df, categories_dict, schema_id, column_keys)
+        if output_path is not None:
+            save_frame(df, output_path)
+
+    if compiled_plan is not None:
+        compiled_plan.save(update_fields=["last_used_at"])
+    elif schema_id is not None:
+        # Only code that ran without errors is worth reusing
+        CompiledPlan.objects.get_or_create(
+            schema_id=schema_id, plan_hash=plan_hash, files_fingerprint=fingerprint, defaults={"code": json.dumps(column_code)}
+        )
+    return df
+
+def frame_content_hash(df: pd.DataFrame) -> str:
+    # Hash of the values, index, columns and dtypes of df
+    digest = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(json.dumps([[str(column), str(dtype)] for column, dtype in df.dtypes.items()]).encode())
+    return digest.hexdigest()
+
+
+def data_quality_report(df: pd.DataFrame, schema: pa.DataFrameSchema, sample_rows: Optional[int] = VALIDATION_SAMPLE_ROWS, max_examples: int = 5, schema_key: Optional[str] = None) -> dict[str, dict]:
+    """
+    Validate df against schema, collecting every failure rather than stopping at the first one, and report them per
+    column: the number of failures, the number per check, and the first max_examples failing row indices and values.
+
+    Frames longer than sample_rows are validated on a random sample of that many rows. Reports are cached by the content
+    of df and the schema, identified by schema_key when given instead of by its serialisation.
+    """
+    sampled = sample_rows is not None and len(df) > sample_rows
+    report_key = "data_quality:" + hashlib.sha256(
+        json.dumps([frame_content_hash(df), schema_key or schema.to_json(), sample_rows if sampled else None, max_examples]).encode()
+    ).hexdigest()
+    report = cache.get(report_key)
+    if report is not None:
+        return report
+
+    try:
+        schema.validate(df, lazy=True, sample=sample_rows if sampled else None, random_state=0)
+        report = {}
+    except pa.errors.SchemaErrors as e:
+        failure_cases = e.failure_cases.copy()
+        # Failures of the frame as a whole are reported against the column they are about when there is one
+        missing_columns = failure_cases["column"].isna() & (failure_cases["check"] == "column_in_dataframe")
+        failure_cases.loc[missing_columns, "column"] = failure_cases.loc[missing_columns, "failure_case"]
+        failure_cases["column"] = failure_cases["column"].fillna("DataFrame").astype(str)
+
+        report = {}
+        for column, column_failures in failure_cases.groupby("column", sort=False):
+            examples = column_failures[column_failures["index"].notna()].sort_values("index").head(max_examples)
+            report[column] = {
+                "failures": len(column_failures),
+                "checks": column_failures["check"].astype(str).value_counts().to_dict(),
+                "sample_rows": examples["index"].tolist(),
+                "sample_values": examples["failure_case"].astype(str).tolist(),
+                "sampled": sampled,
+            }
+    cache.set(report_key, report)
+    return report
+
+
+def run_data_quality_checks(df: pd.DataFrame, schema: pa.DataFrameSchema, schema_key: Optional[str] = None) -> Mapping[str, str]:
+    """
+    The data quality errors of each failing column of df, as a message to show next to the column.
+    """
+    errors = {}
+    for column, column_report in data_quality_report(df, schema, schema_key=schema_key).items():
+        checks = ", ".join(f"{check} ({count})" for check, count in column_report["checks"].items())
+        errors[column] = f"{column_report['failures']} failures: {checks}"
+        if column_report["sample_rows"]:
+            examples = ", ".join(f"row {row}: {value}" for row, value in zip(column_report["sample_rows"], column_report["sample_values"]))
+            errors[column] += f". For example {examples}"
+        if column_report["sampled"]:
+            errors[column] += " (in a sample of the rows)"
+    return errors
+
+def _transformation_prompt(example_df: str, column: str, formula: str) -> str:
+    return f"""This is a sample of my dataframe:
                         {example_df}
                     
                         Write a single-line of code to transform the column `{column}`. Don't write the entire transformation plan, just the code to transform the column.
@@ -393,10 +886,50 @@ def apply_transformations_to_df(orig_df: pd.DataFrame, transformations: Mapping[
                         
                         Answer: The single-line of code to transform the column `{column}` is:
                     """
-        code_to_exec.append(llm(template))
 
-    code_to_exec = "\n".join(code_to_exec)
-    print(code_to_exec)
 
-    exec(code_to_exec)
-    return df
\ No newline at end of file
+def _batched_transformation_prompt(example_df: str) -> str:
+    return f"""This is a sample of my dataframe:
+                        {example_df}
+                    
+                        Write a single-line of code to transform each of the columns listed below. Don't write the entire transformation plan, just the code to transform each column.
+                        Assume we have a target dataframe called df.
+                        
+                        Example: 
+                            Question: The transformation required for column abcd is: normalize by the maximum value
+                            Answer: {{"abcd": "df['abcd'] = df['abcd'] / df['abcd'].max()"}}
+                        
+                        The transformations required are:
+                    """
+
+
+def apply_transformations_to_df(orig_df: pd.DataFrame, transformations: Mapping[str, str], batch_token_budget: int = LLM_BATCH_TOKEN_BUDGET, base_key: Optional[str] = None) -> pd.DataFrame:
+    """
+    Apply transformations, a formula per column, to orig_df.
+
+    Transformed columns are kept in the column store under base_key, which identifies orig_df, so applying the
+    transformations again after editing some of them only recomputes the edited columns and the columns reading them.
+    Without base_key, orig_df is identified by a hash of its content.
+    """
+    example_df = orig_df.head(3).to_markdown()
+    transformations = {column: formula for column, formula in transformations.items() if formula}
+    column_code = generate_column_code(
+        _batched_transformation_prompt(example_df),
+        {column: f"The transformation required for column `{column}` is: {formula}" for column, formula in transformations.items()},
+        lambda column: _transformation_prompt(example_df, column, transformations[column]),
+        batch_token_budget=batch_token_budget,
+        function="transformation_code",
+    )
+    column_code = {column: column_code[column] for column in transformations}
+    logger.debug("Transformation code:\n%s", "\n".join(column_code.values()))
+
+    if base_key is None:
+        base_key = column_key(int(pd.util.hash_pandas_object(orig_df).sum()), orig_df.columns.tolist())
+    df, _ = materialize_columns(
+        column_code,
+        {"orig_df": base_key},
+        lambda variable: orig_df,
+        df=orig_df,
+        base_keys={column: column_key(base_key, column) for column in orig_df.columns},
+    )
+    return df
@@ -0,0 +1,188 @@
+import codecs
+import csv
+import gzip
+import zipfile
+from typing import Iterator, Optional, Sequence, Union
+
+import charset_normalizer
+import pandas as pd
+
+from .profiling import stage
+
+# Bytes of an upload, once decompressed, looked at to sniff its format
+SNIFF_BYTES = 64 * 1024
+SNIFF_DELIMITERS = ',;\t|'
+# Legacy Excel workbooks (.xls) are OLE compound files, which openpyxl can't read
+OLE_MAGIC = b'\xd0\xcf\x11\xe0'
+
+Columns = Optional[Sequence[Union[str, int]]]
+
+
+def _head_bytes(path: str, compression: Optional[str]) -> bytes:
+    if compression == 'gzip':
+        with gzip.open(path, 'rb') as file:
+            return file.read(SNIFF_BYTES)
+    if compression == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            with archive.open(archive.namelist()[0]) as file:
+                return file.read(SNIFF_BYTES)
+    with open(path, 'rb') as file:
+        return file.read(SNIFF_BYTES)
+
+
+def _sniff_encoding(head: bytes) -> str:
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # The sample may end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=len(head) < SNIFF_BYTES)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        match = charset_normalizer.from_bytes(head).best()
+        return match.encoding if match is not None else 'latin-1'
+
+
+def _is_number(field: str) -> bool:
+    try:
+        float(field)
+    except ValueError:
+        return False
+    return True
+
+
+class UnsupportedFormatError(ValueError):
+    pass
+
+
+def check_supported(magic: bytes) -> None:
+    """
+    Raise UnsupportedFormatError when an upload starting with the bytes magic is in a format that can't be read.
+    """
+    if magic.startswith(OLE_MAGIC):
+        raise UnsupportedFormatError("Legacy Excel (.xls) files can't be read, please save the file as .xlsx or CSV.")
+
+
+def sniff_format(path: str) -> dict:
+    """
+    Work out how to read the upload at path: its format (csv, excel or jsonl), compression (gzip, zip or None) and,
+    for text formats, its encoding, and for CSV its delimiter and whether its first row is a header. The result is
+    JSON serialisable, it is stored on the UploadedFile. Raises UnsupportedFormatError for formats that can't be read,
+    see check_supported.
+    """
+    with open(path, 'rb') as file:
+        magic = file.read(8)
+    check_supported(magic)
+    compression = None
+    if magic.startswith(b'\x1f\x8b'):
+        compression = 'gzip'
+    elif magic.startswith(b'PK\x03\x04'):
+        with zipfile.ZipFile(path) as archive:
+            if any(name.startswith('xl/') for name in archive.namelist()):
+                return {'format': 'excel', 'compression': None}
+        compression = 'zip'
+
+    head = _head_bytes(path, compression)
+    encoding = _sniff_encoding(head)
+    text = head.decode(encoding, errors='ignore')
+    if text.lstrip().startswith('{'):
+        return {'format': 'jsonl', 'compression': compression, 'encoding': encoding}
+
+    # The last line of the sample may be cut short
+    sample = text if len(head) < SNIFF_BYTES else text[:text.rfind('\n') + 1]
+    sniffer = csv.Sniffer()
+    try:
+        delimiter = sniffer.sniff(sample, delimiters=SNIFF_DELIMITERS).delimiter
+    except csv.Error:
+        delimiter = ','
+    # The sniffer takes text-only files for headerless, a first row without numbers is taken for a header anyway
+    first_row = next(csv.reader([sample.split('\n', 1)[0]], delimiter=delimiter), [])
+    try:
+        header = sniffer.has_header(sample) or not any(_is_number(field) for field in first_row)
+    except csv.Error:
+        header = True
+    return {'format': 'csv', 'compression': compression, 'encoding': encoding, 'delimiter': delimiter, 'header': header}
+
+
+def _csv_options(file_format: dict) -> dict:
+    return {
+        'sep': file_format['delimiter'],
+        'encoding': file_format['encoding'],
+        'compression': file_format['compression'],
+        'header': 0 if file_format['header'] else None,
+    }
+
+
+def _name_columns(df: pd.DataFrame, file_format: dict) -> pd.DataFrame:
+    # Files without a header get names generated code can refer to
+    if file_format['format'] == 'csv' and not file_format['header']:
+        df.columns = [f'column_{position + 1}' for position in df.columns]
+    return df
+
+
+def _select(df: pd.DataFrame, usecols: Columns) -> pd.DataFrame:
+    if usecols is None:
+        return df
+    if all(isinstance(column, int) for column in usecols):
+        return df.iloc[:, sorted(usecols)]
+    return df[[column for column in df.columns if column in set(usecols)]]
+
+
+def _csv_usecols(usecols: Columns, file_format: dict) -> Columns:
+    # Generated names of headerless files aren't in the file, they are selected by position
+    if usecols is None or file_format['header']:
+        return usecols
+    return [int(str(column).removeprefix('column_')) - 1 if not isinstance(column, int) else column for column in usecols]
+
+
+@stage('read_table')
+def read_table(path: str, file_format: Optional[dict] = None, usecols: Columns = None, nrows: Optional[int] = None) -> pd.DataFrame:
+    """
+    Read the upload at path, sniffing its format unless file_format is given. usecols restricts the read to these
+    columns, by name or position. CSV files are parsed by the multithreaded pyarrow engine, unless only the first
+    nrows rows are wanted.
+    """
+    file_format = file_format or sniff_format(path)
+    if file_format['format'] == 'excel':
+        return _select(pd.read_excel(path, nrows=nrows), usecols)
+    if file_format['format'] == 'jsonl':
+        return _select(pd.read_json(path, lines=True, nrows=nrows, encoding=file_format['encoding'], compression=file_format['compression']), usecols)
+    options = _csv_options(file_format)
+    usecols = _csv_usecols(usecols, file_format)
+    if nrows is not None:
+        df = pd.read_csv(path, usecols=usecols, nrows=nrows, **options)
+    elif usecols is not None and any(isinstance(column, int) for column in usecols):
+        # The pyarrow engine only selects columns by name
+        if file_format['header']:
+            names = pd.read_csv(path, nrows=0, **options).columns
+            df = pd.read_csv(path, engine='pyarrow', usecols=[names[column] if isinstance(column, int) else column for column in usecols], **options)
+        else:
+            df = _select(pd.read_csv(path, engine='pyarrow', **options), usecols)
+    else:
+        df = pd.read_csv(path, engine='pyarrow', usecols=usecols, **options)
+    return _name_columns(df, file_format)
+
+
+def read_header(path: str, file_format: Optional[dict] = None) -> list[str]:
+    return read_table(path, file_format, nrows=1).columns.tolist()
+
+
+def iter_chunks(path: str, chunksize: int, file_format: Optional[dict] = None, usecols: Columns = None, nrows: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read the upload at path chunksize rows at a time, see read_table. The index runs on across chunks.
+    """
+    file_format = file_format or sniff_format(path)
+    if file_format['format'] == 'excel':
+        # Workbooks are read whole anyway
+        df = read_table(path, file_format, usecols=usecols, nrows=nrows)
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+        return
+    if file_format['format'] == 'jsonl':
+        with pd.read_json(path, lines=True, chunksize=chunksize, nrows=nrows, encoding=file_format['encoding'], compression=file_format['compression']) as reader:
+            for chunk in reader:
+                yield _select(chunk, usecols)
+        return
+    with pd.read_csv(path, usecols=_csv_usecols(usecols, file_format), chunksize=chunksize, nrows=nrows, **_csv_options(file_format)) as reader:
+        for chunk in reader:
+            yield _name_columns(chunk, file_format)
+
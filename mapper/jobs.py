@@ -0,0 +1,210 @@
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .frames import new_frame_name
+from .helpers import execute_mapping_plan, generate_description_dict, generate_pandera_schema_from_file, inital_data_mapping_plan, \
+    plan_file_join
+from .llm_accounting import accounting_scope
+from .models import Job, PipelineRun, UploadedFile
+from .profiling import collect_timings, histogram, stage
+from .sandbox import SandboxError
+from .schema_registry import get_schema
+from .storage import local_path, publish, working_path
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two heartbeats of a running job, and without one after which the job is taken for orphaned
+JOB_HEARTBEAT_INTERVAL = getattr(settings, 'JOB_HEARTBEAT_INTERVAL', 30)
+JOB_STALE_AFTER = getattr(settings, 'JOB_STALE_AFTER', 300)
+# Claims of an orphaned job before it is failed instead of queued again, in case the job itself kills its workers
+JOB_MAX_ATTEMPTS = getattr(settings, 'JOB_MAX_ATTEMPTS', 3)
+
+JOB_HANDLERS: dict[str, Callable[[Job], dict]] = {}
+
+
+def job_handler(kind: str):
+    """
+    Register the decorated function as the handler of jobs of the given kind. The handler's return value is stored as
+    the job's result.
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind: str, **payload) -> Job:
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind {kind}")
+    return Job.objects.create(kind=kind, payload=payload)
+
+
+def requeue_stale_jobs() -> int:
+    """
+    Queue again the running jobs whose worker stopped sending heartbeats, e.g. because it was killed, or fail them
+    once they were claimed JOB_MAX_ATTEMPTS times. Returns the number of jobs queued again or failed.
+    """
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=JOB_STALE_AFTER)
+    stale = Job.objects.filter(state=Job.RUNNING).filter(Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff))
+    failed = stale.filter(attempts__gte=JOB_MAX_ATTEMPTS).update(
+        state=Job.FAILED, error='The job stopped responding too many times and was abandoned.', finished_at=now
+    )
+    requeued = stale.filter(attempts__lt=JOB_MAX_ATTEMPTS).update(state=Job.QUEUED, started_at=None, heartbeat_at=None)
+    if failed or requeued:
+        logger.warning('Requeued %d and failed %d jobs whose worker stopped', requeued, failed)
+    return failed + requeued
+
+
+def claim_next_job() -> Optional[Job]:
+    """
+    Take the oldest queued job off the queue, after queuing again the jobs orphaned by a dead worker, see
+    requeue_stale_jobs. Claiming is a conditional update, so when several workers race for the same job exactly one of
+    them gets it.
+    """
+    requeue_stale_jobs()
+    for job in Job.objects.filter(state=Job.QUEUED).order_by('created_at')[:10]:
+        now = timezone.now()
+        claimed = Job.objects.filter(id=job.id, state=Job.QUEUED).update(state=Job.RUNNING, started_at=now, heartbeat_at=now, attempts=F('attempts') + 1)
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def set_progress(job: Job, progress: float, result: Optional[dict] = None) -> None:
+    job.progress = progress
+    update_fields = ['progress']
+    if result is not None:
+        job.result = result
+        update_fields.append('result')
+    job.save(update_fields=update_fields)
+
+
+def _heartbeat(job_id: int, stopped: threading.Event) -> None:
+    try:
+        while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            Job.objects.filter(id=job_id, state=Job.RUNNING).update(heartbeat_at=timezone.now())
+    finally:
+        connection.close()
+
+
+def error_message(job: Job, error: Exception) -> str:
+    """
+    What the user is told about the error that failed job. Errors of the generated code are summed up, as a corrected
+    mapping plan may fix them; anything else only refers to the job, its traceback is in the worker's log.
+    """
+    if isinstance(error, SandboxError):
+        lines = str(error).strip().splitlines()
+        return f'The generated code failed: {lines[-1] if lines else type(error).__name__}'
+    return f'An unexpected error occurred (job {job.id}). Please try again.'
+
+
+def run_job(job: Job) -> Job:
+    # The LLM calls of the job are recorded against it, and against the run and schema it works on if any
+    run_id = job.payload.get('run_id')
+    schema_id = PipelineRun.objects.filter(id=run_id).values_list('schema_id', flat=True).first() if run_id else None
+    stopped = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job.id, stopped), daemon=True).start()
+    # The stages the job runs are kept with it, the worker process's own histogram isn't visible to the web processes
+    with collect_timings() as timings:
+        try:
+            with stage('job'), accounting_scope(job_id=job.id, run_id=run_id, schema_id=schema_id):
+                job.result = JOB_HANDLERS[job.kind](job)
+            job.state = Job.SUCCEEDED
+            job.progress = 1
+        except Exception as e:
+            logger.exception('Job %s (%s) failed', job.id, job.kind)
+            job.state = Job.FAILED
+            job.error = error_message(job, e)
+        finally:
+            stopped.set()
+    job.timings = timings.as_dict()
+    job.finished_at = timezone.now()
+    job.save()
+    return job
+
+
+def job_histogram(limit: int = 1000) -> dict[str, dict]:
+    """
+    Histogram of the stages of the last limit finished jobs of each kind, whichever worker ran them, see
+    profiling.histogram. The duration of a stage is its total over the job.
+    """
+    report = {}
+    for kind in Job.objects.order_by().values_list('kind', flat=True).distinct():
+        durations = {}
+        jobs = Job.objects.filter(kind=kind, finished_at__isnull=False).exclude(timings={}).order_by('-finished_at')
+        for timings in jobs.values_list('timings', flat=True)[:limit]:
+            for name, totals in timings.items():
+                durations.setdefault(name, []).append(totals['wall'])
+        if durations:
+            report[kind] = histogram(durations)
+    return report
+
+
+@job_handler('create_schema')
+def create_schema_job(job: Job) -> dict:
+    example_dataset = UploadedFile.objects.get(id=job.payload['uploaded_file_id'])
+    pandera_schema, df = generate_pandera_schema_from_file(local_path(example_dataset.file.name))
+    set_progress(job, 0.1)
+
+    description_dict, categories_dict = generate_description_dict(df)
+    return {
+        'name': job.payload['name'],
+        'description_dict': description_dict,
+        'pandera_schema': pandera_schema,
+        'categories': json.dumps(categories_dict),
+    }
+
+
+@job_handler('plan_mapping')
+def plan_mapping_job(job: Job) -> dict:
+    run = PipelineRun.objects.select_related('schema').get(id=job.payload['run_id'])
+    schema = run.schema
+    files = [local_path(file.file.name) for file in run.uploaded_files.all()]
+    partial_plan = {}
+
+    def publish_field_plan(field, plan):
+        # Expose each field's plan as soon as it is ready so pollers can already see it
+        partial_plan[field] = plan
+        set_progress(job, len(partial_plan) / len(schema.description_dict), {'mapping_plan': partial_plan})
+
+    started = time.monotonic()
+    run.join_plan = plan_file_join(files)
+    run.record_timing('plan_join', time.monotonic() - started)
+    started = time.monotonic()
+    run.mapping_plan = inital_data_mapping_plan(files, schema.description_dict, get_schema(schema).categories, on_field_planned=publish_field_plan)
+    run.record_timing('plan_mapping', time.monotonic() - started)
+    run.save(update_fields=['join_plan', 'mapping_plan', 'timings', 'updated_at'])
+    return {'mapping_plan': run.mapping_plan}
+
+
+@job_handler('generate_file')
+def generate_file_job(job: Job) -> dict:
+    run = PipelineRun.objects.select_related('schema').get(id=job.payload['run_id'])
+    schema = run.schema
+    files = [local_path(file.file.name) for file in run.uploaded_files.all()]
+
+    def store_code(column_code):
+        run.mapping_code = column_code
+
+    started = time.monotonic()
+    output_name = new_frame_name()
+    df = execute_mapping_plan(files, run.mapping_plan, schema.description_dict, get_schema(schema).categories, schema_id=schema.id, output_path=working_path(output_name), on_code_generated=store_code, join_plan=run.join_plan)
+    publish(output_name)
+    run.record_timing('generate_file', time.monotonic() - started)
+    run.df_name = output_name
+    run.columns = df.columns.tolist()
+    # Transformations applied to an earlier generated file don't apply to this one
+    run.transformed_df_name = ''
+    run.save(update_fields=['mapping_code', 'df_name', 'columns', 'transformed_df_name', 'timings', 'updated_at'])
+    return {'df_name': output_name, 'columns': run.columns}
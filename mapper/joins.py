@@ -0,0 +1,238 @@
+from typing import Callable, Mapping, Optional
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from .ingestion import iter_chunks
+
+# Number of smallest value hashes kept per column. Distinct counts and overlaps are estimated from them
+KEY_SKETCH_SIZE = 1024
+# Rows of each file scanned for key candidates
+KEY_SCAN_ROWS = 1_000_000
+# A column is joined on as the lookup side when at least this fraction of its values are distinct
+KEY_MIN_UNIQUENESS = 0.99
+# A column is joined to a lookup column when at least this fraction of its distinct values are values of the lookup one
+KEY_MIN_COVERAGE = 0.8
+# Fewer distinct values than this in common is too few to tell a key from a coincidence
+KEY_MIN_SHARED_VALUES = 20
+# Numeric columns with fewer distinct values than this are taken for measures (quantities, ratings, flags), never joined
+# from unless their name matches the lookup column
+KEY_MEASURE_MAX_DISTINCT = 100
+# Two ways of joining the same files scoring closer than this are ambiguous, neither is used
+KEY_AMBIGUITY_MARGIN = 0.1
+# Name tokens that say a column is a key without saying of what
+KEY_NAME_NOISE = {'id', 'key', 'code', 'no', 'num', 'number', 'ref'}
+
+
+def _key_values(series: pd.Series) -> pd.Series:
+    # Keys compare as stripped text, with integral floats (integer columns with missing values) written as integers
+    if pd.api.types.is_float_dtype(series.dtype):
+        non_null = series.dropna()
+        if (non_null % 1 == 0).all():
+            series = series.astype('Int64')
+    return series.astype('string').str.strip()
+
+
+def _is_key_like(series: pd.Series) -> bool:
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return False
+    if pd.api.types.is_float_dtype(series.dtype):
+        return bool((series.dropna() % 1 == 0).all())
+    return True
+
+
+def _name_tokens(name) -> list[str]:
+    # customerID, Customer Id and customer_id all split to ['customer', 'id']
+    name = re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', str(name))
+    return [token for token in re.split(r'[^a-z0-9]+', name.lower()) if token]
+
+
+def _name_affinity(left_column, right_column, right_variable: str) -> float:
+    """
+    How alike the names of two columns are, from 1 for the same name to 0 for nothing in common. The name of the
+    lookup file counts for its column, so orders.customer joins customers_df.id.
+    """
+    left_tokens, right_tokens = _name_tokens(left_column), _name_tokens(right_column)
+    if left_tokens == right_tokens:
+        return 1.0
+    left_words = set(left_tokens) - KEY_NAME_NOISE
+    right_words = (set(right_tokens) | set(_name_tokens(right_variable))) - KEY_NAME_NOISE - {'df'}
+    if left_words & set(right_tokens):
+        return 0.7
+    # Abbreviations: cust and customer, qty and quantity
+    if any(left[:3] == right[:3] and (left.startswith(right) or right.startswith(left)) for left in left_words for right in right_words if min(len(left), len(right)) >= 3):
+        return 0.5
+    if left_words & right_words:
+        return 0.5
+    return 0.0
+
+
+class _ColumnSketch:
+    """
+    Bottom-k sketch of the distinct values of a column: the KEY_SKETCH_SIZE smallest hashes of its values. Sketches of
+    two columns hash the same values the same way, so they estimate how many distinct values the columns share.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.key_like = True
+        self.numeric = True
+
+    def update(self, series: pd.Series) -> None:
+        if not self.key_like or not _is_key_like(series):
+            self.key_like = False
+            return
+        self.numeric = self.numeric and pd.api.types.is_numeric_dtype(series.dtype)
+        keys = _key_values(series).dropna()
+        self.rows += len(keys)
+        hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+        self.hashes = np.union1d(self.hashes, hashes)[:KEY_SKETCH_SIZE]
+
+    def distinct(self) -> float:
+        if len(self.hashes) < KEY_SKETCH_SIZE:
+            return float(len(self.hashes))
+        return (KEY_SKETCH_SIZE - 1) / (float(self.hashes[-1]) / 2 ** 64)
+
+    def uniqueness(self) -> float:
+        return min(1.0, self.distinct() / self.rows) if self.rows else 0.0
+
+    def shared(self, other: '_ColumnSketch') -> float:
+        # Estimated number of distinct values of this column that are values of the other one
+        union = np.union1d(self.hashes, other.hashes)[:KEY_SKETCH_SIZE]
+        if not len(union):
+            return 0.0
+        jaccard = (np.isin(union, self.hashes) & np.isin(union, other.hashes)).sum() / len(union)
+        return min(self.distinct(), other.distinct(), jaccard * (self.distinct() + other.distinct()) / (1 + jaccard))
+
+    def coverage(self, other: '_ColumnSketch') -> float:
+        # Estimated fraction of the distinct values of this column that are values of the other one
+        return self.shared(other) / self.distinct() if len(self.hashes) else 0.0
+
+
+def _join_score(left_column, left_sketch: _ColumnSketch, right: str, right_column, right_sketch: _ColumnSketch) -> Optional[float]:
+    """
+    Score, between 0 and 1, of joining a lookup column to a column, None when they can't be joined. Names and types
+    weigh as much as the overlap of values: small integer columns overlap with any id column.
+    """
+    if right_sketch.uniqueness() < KEY_MIN_UNIQUENESS or right_sketch.distinct() < 2:
+        return None
+    shared = left_sketch.shared(right_sketch)
+    coverage = shared / left_sketch.distinct()
+    if shared < KEY_MIN_SHARED_VALUES or coverage < KEY_MIN_COVERAGE:
+        return None
+    name = _name_affinity(left_column, right_column, right)
+    if left_sketch.numeric and left_sketch.distinct() < KEY_MEASURE_MAX_DISTINCT and name < 0.5:
+        return None
+    dtype = 1.0 if left_sketch.numeric == right_sketch.numeric else 0.5
+    # How much of the lookup column the values cover: a measure covers the few smallest ids only
+    containment = shared / right_sketch.distinct()
+    return 0.4 * coverage + 0.2 * containment + 0.3 * name + 0.1 * dtype
+
+
+def _sketch_file(path: str, file_format: Optional[dict] = None, chunksize: int = 100_000) -> dict[str, _ColumnSketch]:
+    sketches = {}
+    for chunk in iter_chunks(path, chunksize, file_format, nrows=KEY_SCAN_ROWS):
+        for column in chunk.columns:
+            sketches.setdefault(column, _ColumnSketch()).update(chunk[column])
+    return {column: sketch for column, sketch in sketches.items() if sketch.key_like and sketch.rows}
+
+
+def infer_join_plan(sources: Mapping[str, str], formats: Optional[Mapping[str, dict]] = None) -> Optional[dict]:
+    """
+    Find how to join the uploads in sources, a mapping of variable name to path, into one frame. formats maps variable
+    names to the format of their upload, sniffed when missing.
+
+    A file can be joined to another on a pair of columns when its column is (nearly) unique and holds most values of
+    the other file's column, at least KEY_MIN_SHARED_VALUES of them, both estimated from sketches of the first
+    KEY_SCAN_ROWS rows of each file. Pairs are scored on their overlap, names and types, see _join_score. When two pairs
+    of columns join the same two files with scores within KEY_AMBIGUITY_MARGIN, the files aren't joined at all: a
+    wrong join silently corrupts every row, a missing one is visible. The file the most other files can be joined to
+    becomes the base, the first one on ties; each row of the joined frame is a row of the base file, with the matching
+    row of every joined file.
+
+    Returns None when no files can be joined, otherwise a JSON serialisable plan: the base variable and the join
+    steps, each joining the right variable on right_column to the left variable, already joined, on left_column.
+    """
+    if len(sources) < 2:
+        return None
+    formats = formats or {}
+    sketches = {variable: _sketch_file(path, formats.get(variable)) for variable, path in sources.items()}
+
+    edges = []
+    for left, left_sketches in sketches.items():
+        for right, right_sketches in sketches.items():
+            if left == right:
+                continue
+            candidates = []
+            for left_column, left_sketch in left_sketches.items():
+                for right_column, right_sketch in right_sketches.items():
+                    score = _join_score(left_column, left_sketch, right, right_column, right_sketch)
+                    if score is not None:
+                        step = {'left': left, 'left_column': left_column, 'right': right, 'right_column': right_column, 'coverage': round(left_sketch.coverage(right_sketch), 3), 'score': round(score, 3)}
+                        candidates.append((score, step))
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+            if len(candidates) > 1 and candidates[0][0] - candidates[1][0] < KEY_AMBIGUITY_MARGIN:
+                continue
+            edges.extend(candidates[:1])
+
+    best_plan = None
+    for base in sources:
+        joined = {base}
+        steps = []
+        while True:
+            options = [(score, step) for score, step in edges if step['left'] in joined and step['right'] not in joined]
+            if not options:
+                break
+            _, step = max(options, key=lambda option: option[0])
+            steps.append(step)
+            joined.add(step['right'])
+        if best_plan is None or len(steps) > len(best_plan['steps']):
+            best_plan = {'base': base, 'steps': steps}
+    return best_plan if best_plan['steps'] else None
+
+
+def align_sources(frames: Mapping[str, pd.DataFrame], join_plan: Mapping) -> dict[str, pd.DataFrame]:
+    """
+    Hash join the frames following join_plan. Every joined frame is returned reindexed like the base frame, holding
+    for each base row the matching row or missing values, so expressions combining columns of several frames line up
+    by key instead of by position. Frames join_plan doesn't mention are returned as they are.
+    """
+    base = frames[join_plan['base']]
+    aligned = {join_plan['base']: base}
+    for step in join_plan['steps']:
+        left_keys = _key_values(aligned[step['left']][step['left_column']])
+        right = frames[step['right']]
+        right_keys = _key_values(right[step['right_column']])
+        # Missing keys match nothing, and the first of duplicated keys wins so that base rows are never repeated
+        keep = (right_keys.notna() & ~right_keys.duplicated()).to_numpy()
+        right, right_keys = right[keep], right_keys[keep]
+        positions = pd.Index(right_keys.to_numpy(dtype=object)).get_indexer(left_keys.to_numpy(dtype=object))
+        positions[left_keys.isna().to_numpy()] = -1
+        joined = right.reset_index(drop=True).reindex(positions)
+        joined.index = base.index
+        aligned[step['right']] = joined
+    return {**frames, **aligned}
+
+
+def joined_variables(join_plan: Mapping) -> list[str]:
+    return [join_plan['base'], *(step['right'] for step in join_plan['steps'])]
+
+
+def joined_source_loader(load_source: Callable[[str], pd.DataFrame], join_plan: Mapping) -> Callable[[str], pd.DataFrame]:
+    """
+    Wrap load_source so that the first variable of join_plan loaded loads and joins all of them, once.
+    """
+    variables = joined_variables(join_plan)
+    joined = {}
+
+    def load(variable: str) -> pd.DataFrame:
+        if variable not in variables:
+            return load_source(variable)
+        if not joined:
+            joined.update(align_sources({name: load_source(name) for name in variables}, join_plan))
+        return joined[variable]
+
+    return load
@@ -0,0 +1,149 @@
+import contextvars
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+
+import pandas as pd
+import tiktoken
+from django.conf import settings
+
+from .models import LLMCall
+
+# Dollars per 1000 prompt tokens and per 1000 completion tokens of each model. Cache hits cost nothing
+LLM_PRICES = getattr(settings, "LLM_PRICES", {"gpt-3.5-turbo": (0.0015, 0.002)})
+
+_call_log = contextvars.ContextVar("llm_call_log", default=None)
+
+
+@lru_cache(maxsize=None)
+def _token_encoding(model: str = "gpt-3.5-turbo"):
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    return len(_token_encoding(model).encode(text))
+
+
+class LLMCallLog:
+    """
+    The LLM calls of one job or request, kept in memory while it runs and written together when it is done.
+    """
+
+    def __init__(self, job_id: Optional[int] = None, run_id: Optional[int] = None, schema_id: Optional[int] = None):
+        self.scope = {"job_id": job_id, "run_id": run_id, "schema_id": schema_id}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add(self, **fields) -> None:
+        with self._lock:
+            self.calls.append(LLMCall(**self.scope, **fields))
+
+    def save(self) -> None:
+        with self._lock:
+            LLMCall.objects.bulk_create(self.calls)
+            self.calls = []
+
+
+@contextmanager
+def accounting_scope(job_id: Optional[int] = None, run_id: Optional[int] = None, schema_id: Optional[int] = None):
+    """
+    Record the LLM calls made in this context, including by ContextThreadPoolExecutor workers, against the job, run
+    and schema given. Calls made outside of any scope aren't recorded.
+    """
+    log = LLMCallLog(job_id, run_id, schema_id)
+    token = _call_log.set(log)
+    try:
+        yield log
+    finally:
+        _call_log.reset(token)
+        log.save()
+
+
+def record_llm_call(function: str, prompt: str, completion: str, latency: float, cache_hit: bool, column: Optional[str] = "", model: str = "gpt-3.5-turbo") -> None:
+    log = _call_log.get()
+    if log is None:
+        return
+    log.add(
+        function=function,
+        column="" if column is None else str(column)[:255],
+        model=model,
+        prompt_tokens=count_tokens(prompt, model),
+        completion_tokens=count_tokens(completion, model),
+        latency=latency,
+        cache_hit=cache_hit,
+        prompt_hash=hashlib.sha256(prompt.encode()).hexdigest(),
+    )
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool running every task in a copy of the context it was submitted from, so the calls of a fan-out are
+    recorded in the scope of the job that fanned out.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def assign_job_calls(job_id: int, schema_id: int) -> int:
+    # The schema a create_schema job describes only exists once it is saved
+    return LLMCall.objects.filter(job_id=job_id, schema__isnull=True).update(schema_id=schema_id)
+
+
+def _calls_frame(since: Optional[datetime] = None) -> pd.DataFrame:
+    calls = LLMCall.objects.all()
+    if since is not None:
+        calls = calls.filter(created_at__gte=since)
+    df = pd.DataFrame.from_records(
+        calls.values("schema_id", "schema__name", "function", "model", "prompt_tokens", "completion_tokens", "latency", "cache_hit", "prompt_hash"),
+        columns=["schema_id", "schema__name", "function", "model", "prompt_tokens", "completion_tokens", "latency", "cache_hit", "prompt_hash"],
+    )
+    prices = df["model"].map(lambda model: LLM_PRICES.get(model, (0.0, 0.0)))
+    cost = (df["prompt_tokens"] * prices.str[0] + df["completion_tokens"] * prices.str[1]) / 1000
+    df["cost"] = cost.where(~df["cache_hit"].astype(bool), 0.0)
+    return df
+
+
+def _summarise(calls: pd.DataFrame) -> pd.Series:
+    # Latencies are those of the calls the provider answered, cache hits would drag the percentiles to zero
+    sent = calls[~calls["cache_hit"].astype(bool)]
+    return pd.Series({
+        "calls": len(calls),
+        "cache_hit_rate": round(calls["cache_hit"].astype(bool).mean(), 3),
+        "prompt_tokens": int(sent["prompt_tokens"].sum()),
+        "completion_tokens": int(sent["completion_tokens"].sum()),
+        "p50_latency": round(sent["latency"].quantile(0.5), 3) if len(sent) else None,
+        "p95_latency": round(sent["latency"].quantile(0.95), 3) if len(sent) else None,
+        "cost": round(sent["cost"].sum(), 4),
+    }, dtype=object)
+
+
+def schema_report(since: Optional[datetime] = None) -> pd.DataFrame:
+    """
+    Calls, cache hit rate, tokens sent, p50/p95 latency and cost of the LLM calls made for each schema, costliest
+    first. Calls no schema is known for are grouped under an empty schema.
+    """
+    df = _calls_frame(since)
+    if df.empty:
+        return pd.DataFrame()
+    df["schema"] = df["schema__name"].fillna("") + df["schema_id"].map(lambda schema_id: f" ({schema_id:.0f})" if pd.notna(schema_id) else "")
+    return df.groupby("schema").apply(_summarise).sort_values("cost", ascending=False)
+
+
+def function_report(since: Optional[datetime] = None) -> pd.DataFrame:
+    """
+    The same figures per calling function, ranked by the prompt tokens they sent, with the number of prompts they sent
+    again identical and the mean size of their prompts: the prompts worth trimming first.
+    """
+    df = _calls_frame(since)
+    if df.empty:
+        return pd.DataFrame()
+    report = df.groupby("function").apply(_summarise)
+    sent = df[~df["cache_hit"].astype(bool)].groupby("function")
+    report["mean_prompt_tokens"] = sent["prompt_tokens"].mean().round(1)
+    report["repeated_prompts"] = sent.size() - sent["prompt_hash"].nunique()
+    return report.sort_values("prompt_tokens", ascending=False)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from langchain.cache import BaseCache
+from langchain.schema import Generation
+
+# Bump this whenever the layout of cached values changes so stale entries are simply never looked up again
+CACHE_KEY_VERSION = 1
+
+
+def cache_key(prompt: str, model: str, temperature: Any = None) -> str:
+    """
+    Content address of an LLM response: a hash of the prompt, the model and the sampling temperature.
+    """
+    payload = json.dumps([CACHE_KEY_VERSION, prompt, model, temperature])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class BaseCacheBackend(ABC):
+    """
+    Storage for cached LLM responses. Values are JSON strings; backends count hits and misses on get.
+    """
+
+    def __init__(self, timeout: Optional[int] = None, **options):
+        # Time to live of an entry in seconds, None keeps entries until they are evicted
+        self.timeout = timeout
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """The value stored under key, None when there is none or it expired. Counts a hit or a miss."""
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        """Store value under key for timeout seconds."""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Remove every entry."""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """Hit and miss counts, and whatever else the backend knows of its size."""
+
+
+class DiskCacheBackend(BaseCacheBackend):
+    """
+    SQLite-backed on-disk cache shared by every worker on the same machine. Entries are evicted least-recently-used
+    first once the cache grows beyond size_limit bytes.
+    """
+
+    def __init__(self, location: str, size_limit: int = 2 ** 30, timeout: Optional[int] = None, **options):
+        import diskcache
+
+        super().__init__(timeout=timeout)
+        self._cache = diskcache.Cache(
+            str(location), size_limit=size_limit, eviction_policy="least-recently-used", **options
+        )
+        # diskcache keeps its own persistent hit/miss counters
+        self._cache.stats(enable=True)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self._cache.set(key, value, expire=self.timeout)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._cache.stats(reset=True)
+
+    def stats(self) -> dict:
+        hits, misses = self._cache.stats()
+        return {"hits": hits, "misses": misses, "entries": len(self._cache), "size": self._cache.volume()}
+
+
+class DjangoCacheBackend(BaseCacheBackend):
+    """
+    Stores responses in one of the Django caches (memcached in production), shared by every worker and node. Eviction
+    is left to the cache server.
+    """
+
+    key_prefix = "llm_cache"
+
+    def __init__(self, alias: str = "default", timeout: Optional[int] = None, **options):
+        super().__init__(timeout=timeout)
+        self.alias = alias
+
+    @property
+    def _cache(self):
+        return caches[self.alias]
+
+    def _count(self, counter: str) -> None:
+        counter_key = f"{self.key_prefix}:{counter}"
+        self._cache.add(counter_key, 0, timeout=None)
+        try:
+            self._cache.incr(counter_key)
+        except ValueError:
+            # The counter was evicted between add and incr
+            self._cache.set(counter_key, 1, timeout=None)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._cache.get(f"{self.key_prefix}:{key}")
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._cache.set(f"{self.key_prefix}:{key}", value, timeout=self.timeout)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self._cache.get(f"{self.key_prefix}:hits", 0),
+            "misses": self._cache.get(f"{self.key_prefix}:misses", 0),
+        }
+
+
+class LLMResponseCache(BaseCache):
+    """
+    Persistent, content-addressed cache for LLM responses.
+
+    It is installed as langchain.llm_cache so every llm(...) and LLMChain.run call goes through it, and exposes
+    get_json/set_json for callers that are not langchain LLMs, such as marvin models.
+    """
+
+    def __init__(self, backend: BaseCacheBackend):
+        self.backend = backend
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list[Generation]]:
+        # llm_string is langchain's serialisation of the LLM parameters, which includes the model and temperature
+        generations = self.get_json(cache_key(prompt, llm_string))
+        if generations is None:
+            return None
+        return [Generation(**generation) for generation in generations]
+
+    def update(self, prompt: str, llm_string: str, return_val: list[Generation]) -> None:
+        self.set_json(cache_key(prompt, llm_string), [generation.dict() for generation in return_val])
+
+    def clear(self, **kwargs: Any) -> None:
+        self.backend.clear()
+
+    def get_json(self, key: str) -> Any:
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set_json(self, key: str, value: Any) -> None:
+        self.backend.set(key, json.dumps(value))
+
+    def stats(self) -> dict:
+        return self.backend.stats()
+
+
+_llm_cache = None
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """
+    Return the process-wide LLM response cache configured by settings.LLM_CACHE.
+    """
+    global _llm_cache
+    if _llm_cache is None:
+        config = dict(getattr(settings, "LLM_CACHE", {}))
+        backend_cls = import_string(config.pop("BACKEND", "mapper.llm_cache.DiskCacheBackend"))
+        options = {key.lower(): value for key, value in config.items()}
+        _llm_cache = LLMResponseCache(backend_cls(**options))
+    return _llm_cache
@@ -0,0 +1,103 @@
+import os
+import threading
+from functools import lru_cache
+from typing import Any, Callable
+
+import openai
+import requests
+from django.conf import settings
+from langchain import OpenAI
+from requests.adapters import HTTPAdapter
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from .profiling import stage
+
+# Base URL of the completions API, e.g. http://localhost:8001/v1 for the llm_stub_server command. None keeps OpenAI's
+LLM_API_BASE = getattr(settings, "LLM_API_BASE", None)
+# Seconds a single request may take before it is abandoned and retried
+LLM_REQUEST_TIMEOUT = getattr(settings, "LLM_REQUEST_TIMEOUT", 60)
+# Attempts per call, and the longest randomised wait between two of them
+LLM_MAX_ATTEMPTS = getattr(settings, "LLM_MAX_ATTEMPTS", 6)
+LLM_RETRY_MAX_WAIT = getattr(settings, "LLM_RETRY_MAX_WAIT", 60)
+# Requests in flight to the provider at once across every thread of the process, whatever fans them out
+LLM_GLOBAL_CONCURRENCY = getattr(settings, "LLM_GLOBAL_CONCURRENCY", 16)
+# Keep-alive connections kept open to the provider
+LLM_POOL_SIZE = getattr(settings, "LLM_POOL_SIZE", LLM_GLOBAL_CONCURRENCY)
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_semaphore = threading.BoundedSemaphore(LLM_GLOBAL_CONCURRENCY)
+
+
+def get_session() -> requests.Session:
+    """
+    The HTTP session every OpenAI request of this process goes through, created on first use. Its connection pool
+    keeps LLM_POOL_SIZE connections alive, so requests after the first skip the TCP and TLS handshakes.
+    """
+    global _session, _session_pid
+    with _lock:
+        # Connections must not be shared with a forked parent
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LLM_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+def configure() -> None:
+    # openai reads these globals on every request. marvin's requests are asynchronous and open their own connections,
+    # but go to LLM_API_BASE too
+    openai.requestssession = get_session
+    if LLM_API_BASE:
+        openai.api_base = LLM_API_BASE
+
+
+@lru_cache(maxsize=None)
+def get_llm(model_name: str = "gpt-3.5-turbo", temperature: float = 0.0) -> OpenAI:
+    """
+    The langchain LLM for model_name and temperature, one per process. Retries are left to call, so langchain makes
+    a single attempt.
+    """
+    configure()
+    return OpenAI(
+        model_name=model_name,
+        temperature=temperature,
+        request_timeout=LLM_REQUEST_TIMEOUT,
+        max_retries=1,
+        **({"openai_api_base": LLM_API_BASE} if LLM_API_BASE else {}),
+    )
+
+
+def call(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Call fn, a function making one LLM request, holding one of the LLM_GLOBAL_CONCURRENCY slots of the process.
+    Transient errors are retried after a randomised exponential wait, without holding a slot, so the workers of a
+    fan-out that hit the rate limit together don't retry in lockstep.
+    """
+    retrying = Retrying(
+        reraise=True,
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        wait=wait_random_exponential(multiplier=1, max=LLM_RETRY_MAX_WAIT),
+        stop=stop_after_attempt(LLM_MAX_ATTEMPTS),
+    )
+
+    def attempt():
+        with _semaphore:
+            return fn(*args, **kwargs)
+
+    with stage("llm"):
+        return retrying(attempt)
+
+
+configure()
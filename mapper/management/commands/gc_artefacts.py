@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from mapper.retention import ARTEFACT_RETENTION_SECONDS, collect_garbage
+
+
+class Command(BaseCommand):
+    help = "Delete mapped frames no pipeline run refers to any more, stale stored columns and stale local copies."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=float, default=ARTEFACT_RETENTION_SECONDS, help="Seconds an artefact is kept for.")
+
+    def handle(self, *args, **options):
+        deleted = collect_garbage(options["max_age"])
+        self.stdout.write(", ".join(f"Deleted {count} {kind}" for kind, count in deleted.items()))
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mapper.llm_accounting import function_report, schema_report
+
+
+class Command(BaseCommand):
+    help = "Report the calls, tokens, p50/p95 latency and cost of the recorded LLM calls per schema and per calling function."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=float, default=None, help="Only report the calls of the last days.")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options["days"]) if options["days"] is not None else None
+        schemas = schema_report(since)
+        if schemas.empty:
+            self.stdout.write("No LLM calls recorded")
+            return
+        self.stdout.write("Per schema, costliest first\n")
+        self.stdout.write(schemas.to_string())
+        self.stdout.write("\nPer calling function, most prompt tokens sent first\n")
+        self.stdout.write(function_report(since).to_string())
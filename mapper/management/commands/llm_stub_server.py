@@ -0,0 +1,74 @@
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a stand-in for the OpenAI completions API answering every prompt with the same reply, to exercise the "
+        "LLM gateway locally. Point LLM_API_BASE at http://localhost:<port>/v1."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--reply", default="df['column'] = None", help="Text of every completion.")
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds each response is delayed by.")
+        parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests answered 429 or 503.")
+
+    def handle(self, *args, **options):
+        stdout = self.stdout
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, as the API does, so connection reuse by the gateway can be observed
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                time.sleep(options["latency"])
+                if random.random() < options["failure_rate"]:
+                    status = random.choice([429, 503])
+                    return self._respond(status, {"error": {"message": "Stub failure", "type": "stub_error", "code": status}})
+                reply = options["reply"]
+                if self.path.endswith("/chat/completions"):
+                    prompt = " ".join(message["content"] for message in request.get("messages", []))
+                    choice = {"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}
+                elif self.path.endswith("/completions"):
+                    prompt = request.get("prompt", "")
+                    choice = {"index": 0, "text": reply, "logprobs": None, "finish_reason": "stop"}
+                else:
+                    return self._respond(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                # Tokens approximated by words, enough for accounting to add up
+                usage = {"prompt_tokens": len(str(prompt).split()), "completion_tokens": len(reply.split())}
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                self._respond(200, {
+                    "id": f"stub-{uuid.uuid4().hex}",
+                    "object": "chat.completion" if "message" in choice else "text_completion",
+                    "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [choice],
+                    "usage": usage,
+                })
+
+            def _respond(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                stdout.write(f"{self.client_address[0]}:{self.client_address[1]} {format % args}")
+
+        server = ThreadingHTTPServer(("127.0.0.1", options["port"]), Handler)
+        self.stdout.write(f"Serving stub completions on http://127.0.0.1:{options['port']}/v1")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
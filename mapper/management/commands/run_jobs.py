@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mapper.jobs import claim_next_job, run_job
+from mapper.schema_registry import warm_schema_registry
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs, polling the database for new ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Parsed {warm_schema_registry()} schemas")
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+
+            self.stdout.write(f"Running job {job.id} ({job.kind})")
+            job = run_job(job)
+            self.stdout.write(f"Job {job.id} {job.state}")
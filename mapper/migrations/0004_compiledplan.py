@@ -0,0 +1,43 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mapper", "0003_remove_schema_description_schema_categories"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CompiledPlan",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("plan_hash", models.CharField(max_length=64)),
+                ("files_fingerprint", models.CharField(max_length=64)),
+                ("code", models.TextField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("last_used_at", models.DateTimeField(auto_now=True)),
+                (
+                    "schema",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="compiled_plans",
+                        to="mapper.schema",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("schema", "plan_hash", "files_fingerprint")},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mapper", "0005_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadedfile",
+            name="metadata",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
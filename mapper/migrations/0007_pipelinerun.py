@@ -0,0 +1,61 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mapper", "0006_uploadedfile_metadata"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PipelineRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("mapping_plan", models.JSONField(blank=True, null=True)),
+                ("mapping_code", models.JSONField(blank=True, null=True)),
+                ("df_name", models.CharField(blank=True, max_length=255)),
+                ("transformed_df_name", models.CharField(blank=True, max_length=255)),
+                ("columns", models.JSONField(blank=True, null=True)),
+                ("timings", models.JSONField(default=dict)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "schema",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="runs",
+                        to="mapper.schema",
+                    ),
+                ),
+                (
+                    "uploaded_files",
+                    models.ManyToManyField(
+                        related_name="runs", to="mapper.uploadedfile"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["schema", "created_at"],
+                        name="mapper_pipe_schema__337eab_idx",
+                    ),
+                    models.Index(
+                        fields=["updated_at"], name="mapper_pipe_updated_3d940d_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mapper", "0007_pipelinerun"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pipelinerun",
+            name="join_plan",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
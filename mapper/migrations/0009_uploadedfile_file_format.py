@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mapper", "0008_pipelinerun_join_plan"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadedfile",
+            name="file_format",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
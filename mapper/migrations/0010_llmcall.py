@@ -0,0 +1,78 @@
+# Generated by Django 4.2.1 on 2026-10-18 19:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mapper", "0009_uploadedfile_file_format"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LLMCall",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("function", models.CharField(max_length=64)),
+                ("column", models.CharField(blank=True, max_length=255)),
+                ("model", models.CharField(max_length=64)),
+                ("prompt_tokens", models.IntegerField()),
+                ("completion_tokens", models.IntegerField()),
+                ("latency", models.FloatField()),
+                ("cache_hit", models.BooleanField()),
+                ("prompt_hash", models.CharField(max_length=64)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "job",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="llm_calls",
+                        to="mapper.job",
+                    ),
+                ),
+                (
+                    "run",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="llm_calls",
+                        to="mapper.pipelinerun",
+                    ),
+                ),
+                (
+                    "schema",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="llm_calls",
+                        to="mapper.schema",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["schema", "created_at"],
+                        name="mapper_llmc_schema__524445_idx",
+                    ),
+                    models.Index(
+                        fields=["created_at"], name="mapper_llmc_created_7e5283_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
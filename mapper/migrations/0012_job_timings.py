@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 19:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mapper", "0011_job_heartbeat"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="timings",
+            field=models.JSONField(default=dict),
+        ),
+    ]
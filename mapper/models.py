@@ -6,6 +6,10 @@ from django.db import models
 
 class UploadedFile(models.Model):
     file = models.FileField(upload_to='uploads/')
+    # Header, dtypes and a head sample read once at upload time, so prompts don't need to parse the file again
+    metadata = models.JSONField(null=True, blank=True)
+    # Format, compression, encoding, delimiter and header sniffed once at upload time, see ingestion.sniff_format
+    file_format = models.JSONField(null=True, blank=True)
 
 
 class Schema(models.Model):
@@ -14,3 +18,108 @@ class Schema(models.Model):
     pandera_schema = models.JSONField()
     categories = models.JSONField(null=True)
     # description = models.TextField(blank=True, null=True)
+
+
+class CompiledPlan(models.Model):
+    # Generated mapping code, reused while the schema, the mapping plan and the input file columns stay the same
+    schema = models.ForeignKey(Schema, on_delete=models.CASCADE, related_name='compiled_plans')
+    plan_hash = models.CharField(max_length=64)
+    files_fingerprint = models.CharField(max_length=64)
+    code = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('schema', 'plan_hash', 'files_fingerprint')
+
+
+class Job(models.Model):
+    # A unit of background work, taken from the queue by the run_jobs worker
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=64)
+    state = models.CharField(max_length=16, choices=STATES, default=QUEUED)
+    payload = models.JSONField(default=dict)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    # Fraction of the work done, between 0 and 1
+    progress = models.FloatField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Bumped by the worker running the job, a running job whose heartbeat stopped lost its worker
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # Times the job was claimed by a worker
+    attempts = models.PositiveIntegerField(default=0)
+    # Count, wall and CPU seconds and peak memory of each profiling stage the job ran, see profiling.collect_timings
+    timings = models.JSONField(default=dict)
+
+    class Meta:
+        indexes = [models.Index(fields=['state', 'created_at'])]
+
+    @property
+    def is_finished(self):
+        return self.state in (self.SUCCEEDED, self.FAILED)
+
+
+class PipelineRun(models.Model):
+    # One pass of uploaded files through the pipeline, from the mapping plan to the transformed output. Views address
+    # it by id, so a run can be resumed from any worker or shared by its URL
+    schema = models.ForeignKey(Schema, on_delete=models.CASCADE, related_name='runs')
+    uploaded_files = models.ManyToManyField(UploadedFile, related_name='runs')
+    mapping_plan = models.JSONField(null=True, blank=True)
+    # How the uploaded files are joined on their key columns, None when they aren't, see joins.infer_join_plan
+    join_plan = models.JSONField(null=True, blank=True)
+    # Code generated for each output column by the last mapping
+    mapping_code = models.JSONField(null=True, blank=True)
+    # Storage names of the mapped frame and of the frame with the transformations applied, see frames
+    df_name = models.CharField(max_length=255, blank=True)
+    transformed_df_name = models.CharField(max_length=255, blank=True)
+    columns = models.JSONField(null=True, blank=True)
+    # Seconds each stage of the pipeline took the last time it ran
+    timings = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['schema', 'created_at']),
+            models.Index(fields=['updated_at']),
+        ]
+
+    def record_timing(self, stage: str, seconds: float) -> None:
+        self.timings = {**self.timings, stage: seconds}
+
+
+class LLMCall(models.Model):
+    # One prompt answered by the LLM or its cache, recorded for the job or request that sent it, see llm_accounting
+    job = models.ForeignKey(Job, null=True, blank=True, on_delete=models.SET_NULL, related_name='llm_calls')
+    run = models.ForeignKey(PipelineRun, null=True, blank=True, on_delete=models.SET_NULL, related_name='llm_calls')
+    schema = models.ForeignKey(Schema, null=True, blank=True, on_delete=models.SET_NULL, related_name='llm_calls')
+    # The helper that sent the prompt and the output column it was about, if any
+    function = models.CharField(max_length=64)
+    column = models.CharField(max_length=255, blank=True)
+    model = models.CharField(max_length=64)
+    prompt_tokens = models.IntegerField()
+    completion_tokens = models.IntegerField()
+    # Seconds until the answer came back, retries included
+    latency = models.FloatField()
+    cache_hit = models.BooleanField()
+    # Hash of the prompt, to spot the same prompt sent again
+    prompt_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['schema', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
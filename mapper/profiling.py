@@ -0,0 +1,221 @@
+import cProfile
+import contextvars
+import functools
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Iterable, Mapping, Optional
+
+import numpy as np
+from django.conf import settings
+
+# Durations kept per stage for the histogram, the newest replacing the oldest
+PROFILING_HISTORY_SIZE = getattr(settings, "PROFILING_HISTORY_SIZE", 1000)
+# Requests sending this header are profiled with cProfile, when PROFILING_CPROFILE allows it
+PROFILING_HEADER = getattr(settings, "PROFILING_HEADER", "X-Profile")
+PROFILING_CPROFILE = getattr(settings, "PROFILING_CPROFILE", settings.DEBUG)
+# Trace allocations so stages report their peak memory. Slows every allocation down and serves one request at a time
+# per process, off by default
+PROFILING_TRACE_MEMORY = getattr(settings, "PROFILING_TRACE_MEMORY", False)
+# cProfile reports kept for the debug endpoint, and functions listed in each
+PROFILING_REPORTS_KEPT = 20
+PROFILING_REPORT_LINES = 60
+# Upper bounds of the histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 60000)
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+_lock = threading.Lock()
+# Held by the request being served while tracemalloc traces, see ProfilingMiddleware
+_trace_lock = threading.Lock()
+_history: dict[str, deque] = {}
+_reports: OrderedDict[str, str] = OrderedDict()
+
+
+class RequestTimings:
+    """
+    Totals of the stages run while serving one request or running one job, fan-out workers included, rendered as a
+    Server-Timing header or stored with the job.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, wall: float, cpu: float, memory: Optional[int]) -> None:
+        with self._lock:
+            totals = self.stages.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0, "memory": None})
+            totals["count"] += 1
+            totals["wall"] += wall
+            totals["cpu"] += cpu
+            if memory is not None:
+                totals["memory"] = max(totals["memory"] or 0, memory)
+
+    def server_timing(self) -> str:
+        entries = []
+        with self._lock:
+            for name, totals in self.stages.items():
+                description = f"{totals['count']}x, cpu {totals['cpu'] * 1000:.1f}ms"
+                if totals["memory"] is not None:
+                    description += f", peak {totals['memory'] / 1024 ** 2:.1f}MB"
+                entries.append(f'{name};dur={totals["wall"] * 1000:.1f};desc="{description}"')
+        return ", ".join(entries)
+
+    def as_dict(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                name: {**totals, "wall": round(totals["wall"], 4), "cpu": round(totals["cpu"], 4)}
+                for name, totals in self.stages.items()
+            }
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collect the stages run in this context, including by ContextThreadPoolExecutor workers, into a RequestTimings.
+    """
+    timings = RequestTimings()
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+class stage:
+    """
+    Time a block, or every call of a decorated function, as the stage name: wall time, CPU time of the thread and,
+    while tracemalloc traces, the peak memory allocated above what was allocated on entry. Stages nest, the time of a
+    stage includes the stages it runs. Times go to the Server-Timing header of the request being served or to the job
+    being run, if any, and to the histogram of the stage.
+
+    tracemalloc keeps one peak for the whole process, which every stage resets on entry. ProfilingMiddleware serves
+    one request at a time while tracing so requests don't reset each other's peaks, but stages run in parallel by the
+    fan-out workers of a request still do: their peaks are only indicative.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.child_peak = 0
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        self.memory_start = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            parent = _current_stage.get()
+            # Resetting the peak would hide the enclosing stage's peak so far, it is handed to it first
+            if parent is not None:
+                parent.child_peak = max(parent.child_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = current
+        self._token = _current_stage.set(self)
+        self.started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.started
+        cpu = time.thread_time() - self.cpu_started
+        _current_stage.reset(self._token)
+        memory = None
+        if self.memory_start is not None and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            memory = max(0, peak - self.memory_start)
+            parent = _current_stage.get()
+            if parent is not None:
+                parent.child_peak = max(parent.child_peak, peak)
+
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(self.name, wall, cpu, memory)
+        with _lock:
+            _history.setdefault(self.name, deque(maxlen=PROFILING_HISTORY_SIZE)).append(wall)
+
+
+def histogram(durations: Optional[Mapping[str, Iterable[float]]] = None) -> dict[str, dict]:
+    """
+    Percentiles and bucket counts, in milliseconds, of durations, seconds by stage name. Defaults to the last
+    PROFILING_HISTORY_SIZE durations of every stage run by this process.
+    """
+    if durations is None:
+        with _lock:
+            durations = {name: list(history) for name, history in _history.items()}
+    durations = {name: np.array(list(seconds), dtype=float) * 1000 for name, seconds in durations.items()}
+    labels = [f"<={bound}ms" for bound in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}ms"]
+    result = {}
+    for name, ms in sorted(durations.items()):
+        if not len(ms):
+            continue
+        counts = np.bincount(np.searchsorted(HISTOGRAM_BUCKETS_MS, ms), minlength=len(labels))
+        result[name] = {
+            "count": len(ms),
+            **{f"p{percentile}": round(float(np.percentile(ms, percentile)), 1) for percentile in (50, 95, 99)},
+            "max": round(float(ms.max()), 1),
+            "buckets": dict(zip(labels, counts.tolist())),
+        }
+    return result
+
+
+def _keep_report(profiler: cProfile.Profile) -> str:
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILING_REPORT_LINES)
+    report_id = uuid.uuid4().hex
+    with _lock:
+        _reports[report_id] = output.getvalue()
+        while len(_reports) > PROFILING_REPORTS_KEPT:
+            _reports.popitem(last=False)
+    return report_id
+
+
+def profile_report(report_id: str) -> Optional[str]:
+    with _lock:
+        return _reports.get(report_id)
+
+
+class ProfilingMiddleware:
+    """
+    Time every request and the stages it runs, see stage, and send them back in a Server-Timing header. Requests
+    sending the PROFILING_HEADER header are also run under cProfile, when PROFILING_CPROFILE is set; the id of their
+    report, served by the debug endpoint, comes back in an X-Profile-Id header. cProfile only sees the request's own
+    thread, not fan-out workers. While PROFILING_TRACE_MEMORY traces allocations, requests are served one at a time,
+    see stage.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if PROFILING_TRACE_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __call__(self, request):
+        if tracemalloc.is_tracing():
+            with _trace_lock:
+                return self._serve(request)
+        return self._serve(request)
+
+    def _serve(self, request):
+        profiler = cProfile.Profile() if PROFILING_CPROFILE and request.headers.get(PROFILING_HEADER) else None
+        with collect_timings() as timings, stage("total"):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+
+        response["Server-Timing"] = timings.server_timing()
+        if profiler is not None:
+            response["X-Profile-Id"] = _keep_report(profiler)
+        return response
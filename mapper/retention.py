@@ -0,0 +1,32 @@
+from django.conf import settings
+
+from .column_store import COLUMN_STORE_DIRECTORY
+from .frames import FRAME_DIRECTORY
+from .models import PipelineRun
+from .storage import delete, iter_stored_files, prune_local_copies
+
+ARTEFACT_RETENTION_SECONDS = getattr(settings, 'ARTEFACT_RETENTION_SECONDS', 7 * 24 * 60 * 60)
+
+
+def referenced_frames() -> set[str]:
+    # The frames pipeline runs still point to
+    names = set()
+    for df_name, transformed_df_name in PipelineRun.objects.values_list('df_name', 'transformed_df_name').iterator():
+        names.update(name for name in (df_name, transformed_df_name) if name)
+    return names
+
+
+def collect_garbage(max_age: float = ARTEFACT_RETENTION_SECONDS) -> dict[str, int]:
+    """
+    Delete the artefacts older than max_age seconds: mapped frames no pipeline run refers to any more, stored columns,
+    which are recomputed when needed again, and local copies of stored files. Returns the number deleted of each.
+    """
+    referenced = referenced_frames()
+    deleted = {'frames': 0, 'columns': 0}
+    for directory, kind in ((FRAME_DIRECTORY, 'frames'), (COLUMN_STORE_DIRECTORY, 'columns')):
+        for name, age in list(iter_stored_files(directory)):
+            if age > max_age and name not in referenced:
+                delete(name)
+                deleted[kind] += 1
+    deleted['local_copies'] = prune_local_copies(max_age)
+    return deleted
@@ -0,0 +1,204 @@
+import math
+import multiprocessing
+import os
+import queue
+import resource
+import tempfile
+import threading
+import traceback
+import uuid
+from typing import Mapping, Optional
+
+import pandas as pd
+import pyarrow as pa
+from django.conf import settings
+
+from .profiling import stage
+
+# Frames are exchanged with the workers as Arrow IPC files, in shared memory when the system has it
+EXCHANGE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class SandboxError(Exception):
+    pass
+
+
+class SandboxTimeout(SandboxError):
+    pass
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    try:
+        return pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Object columns mixing several types can't be represented in Arrow, keep them as text
+        df = df.copy()
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=True)
+
+
+def _write_frame(df: pd.DataFrame, path: str) -> None:
+    table = _to_arrow(df)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_frame(path: str) -> pd.DataFrame:
+    # Memory-mapped, so the frame isn't copied through a pipe or a pickle
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def _virtual_memory_size() -> int:
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmSize:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _worker_main(conn, memory_bytes: Optional[int]) -> None:
+    # Runs in the worker process. pandas and pyarrow are imported by the module already, so runs start warm.
+    if memory_bytes:
+        # Linux doesn't enforce RSS limits, so cap the address space the worker may grow by instead
+        limit = _virtual_memory_size() + memory_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    while True:
+        request = conn.recv()
+        if request is None:
+            return
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_used = math.ceil(usage.ru_utime + usage.ru_stime)
+        _, cpu_hard_limit = resource.getrlimit(resource.RLIMIT_CPU)
+        if request['cpu_seconds']:
+            # RLIMIT_CPU counts the CPU time of the whole process; the kernel kills the worker with SIGXCPU past it
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_used + request['cpu_seconds'], cpu_hard_limit))
+        try:
+            namespace = {'pd': pd}
+            for name, path in request['frames'].items():
+                namespace[name] = _read_frame(path)
+            exec(request['code'], namespace)
+            _write_frame(namespace[request['result']], request['output_path'])
+            conn.send({'ok': True})
+        except MemoryError:
+            conn.send({'ok': False, 'error': 'The code ran out of memory.'})
+        except Exception:
+            conn.send({'ok': False, 'error': traceback.format_exc()})
+        finally:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_hard_limit, cpu_hard_limit))
+
+
+class _Worker:
+    def __init__(self, context, memory_bytes: Optional[int]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_bytes), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        # Safe to call on a worker that is already dead or killed
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class Sandbox:
+    """
+    A pool of pre-started worker processes that run generated pandas code away from the web worker.
+
+    Each run is limited to cpu_seconds of CPU time and timeout seconds of wall-clock time, and each worker to
+    memory_bytes of memory on top of what it uses when idle. A worker that breaks a limit is killed and replaced.
+    Input and result frames are passed as Arrow IPC files.
+    """
+
+    def __init__(self, size: int = 2, timeout: float = 300, cpu_seconds: int = 300, memory_bytes: Optional[int] = 2 * 1024 ** 3):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        # Workers are spawned rather than forked, the web process may be running threads
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(_Worker(self._context, memory_bytes))
+
+    def execute(self, code: str, frames: Optional[Mapping[str, pd.DataFrame]] = None, result: str = 'df', timeout: Optional[float] = None) -> pd.DataFrame:
+        """
+        Run code with pd and frames in its namespace and return the frame it leaves in the variable named result.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        run_id = uuid.uuid4().hex
+        frame_paths = {name: os.path.join(EXCHANGE_DIR, f'sandbox-{run_id}-{name}.arrow') for name in (frames or {})}
+        output_path = os.path.join(EXCHANGE_DIR, f'sandbox-{run_id}-{result}.arrow')
+
+        worker = self._idle.get()
+        # Only a worker that answered, or was never sent the run, is known to be ready for the next one
+        healthy = True
+        try:
+            if not worker.process.is_alive():
+                # Killed while idle, e.g. by the OOM killer
+                worker.kill()
+                worker = _Worker(self._context, self.memory_bytes)
+            for name, df in (frames or {}).items():
+                _write_frame(df, frame_paths[name])
+            healthy = False
+            try:
+                worker.conn.send({
+                    'code': code,
+                    'frames': frame_paths,
+                    'result': result,
+                    'output_path': output_path,
+                    'cpu_seconds': self.cpu_seconds,
+                })
+                if not worker.conn.poll(timeout):
+                    raise SandboxTimeout(f'The code did not finish within {timeout} seconds.')
+                response = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.kill()
+                raise SandboxError(f'The worker running the code died (exit code {worker.process.exitcode}), it probably ran out of CPU time or memory.')
+            healthy = True
+            if not response['ok']:
+                raise SandboxError(response['error'])
+            return _read_frame(output_path)
+        finally:
+            if not healthy:
+                worker.kill()
+                worker = _Worker(self._context, self.memory_bytes)
+            self._idle.put(worker)
+            for path in [*frame_paths.values(), output_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+_sandbox = None
+_sandbox_lock = threading.Lock()
+
+
+def get_sandbox() -> Sandbox:
+    """
+    Return the process-wide sandbox, starting its workers on first use.
+    """
+    global _sandbox
+    with _sandbox_lock:
+        if _sandbox is None:
+            _sandbox = Sandbox(
+                size=settings.SANDBOX_WORKERS,
+                timeout=settings.SANDBOX_TIMEOUT,
+                cpu_seconds=settings.SANDBOX_CPU_SECONDS,
+                memory_bytes=settings.SANDBOX_MEMORY_BYTES,
+            )
+    return _sandbox
+
+
+@stage('exec')
+def run_code(code: str, frames: Optional[Mapping[str, pd.DataFrame]] = None, result: str = 'df') -> pd.DataFrame:
+    """
+    Run generated code and return the frame it leaves in result, in the sandbox unless SANDBOX_ENABLED is off.
+    """
+    if settings.SANDBOX_ENABLED:
+        return get_sandbox().execute(code, frames, result)
+    # exec can't rebind the locals of the caller, so the generated code gets its own namespace
+    namespace = {'pd': pd, **(frames or {})}
+    exec(code, namespace)
+    return namespace[result]
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pandera as pa
+
+from .ingestion import iter_chunks, read_header, sniff_format
+
+# Text columns with at most this many distinct values, each seen at least twice on average, get an isin check
+ALLOWED_VALUES_MAX = 20
+
+
+def _column_group_statistics(path: str, file_format: dict, positions: list[int], chunksize: int, sample_size: int, seed: int) -> dict:
+    # Runs in a worker process: stream the columns at positions of the file at path, only those are parsed
+    statistics = {}
+    rows = 0
+    rng = np.random.default_rng(seed)
+    sample = None
+    sample_keys = np.empty(0)
+    for chunk in iter_chunks(path, chunksize, file_format, usecols=positions):
+        chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+        rows += len(chunk)
+
+        for column in chunk.columns:
+            column_statistics = statistics.setdefault(column, {'dtypes': set(), 'nullable': False, 'min': None, 'max': None, 'values': set(), 'too_many_values': False})
+            series = chunk[column]
+            if series.isna().any():
+                column_statistics['nullable'] = True
+            if series.isna().all():
+                # An all-null chunk is read as float whatever the column holds, it says nothing about the dtype
+                continue
+            column_statistics['dtypes'].add(str(series.dtype))
+            if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+                column_min, column_max = float(series.min()), float(series.max())
+                column_statistics['min'] = column_min if column_statistics['min'] is None else min(column_statistics['min'], column_min)
+                column_statistics['max'] = column_max if column_statistics['max'] is None else max(column_statistics['max'], column_max)
+            elif series.dtype == object and not column_statistics['too_many_values']:
+                column_statistics['values'].update(series.dropna().unique())
+                if len(column_statistics['values']) > ALLOWED_VALUES_MAX:
+                    column_statistics['too_many_values'] = True
+                    column_statistics['values'] = set()
+
+        # Bottom-k sample: every row draws a random key and the sample_size rows with the smallest keys are kept. All
+        # workers draw the same keys from the same seed, so their samples hold the same rows
+        keys = rng.random(len(chunk))
+        if len(sample_keys) >= sample_size:
+            candidates = keys < sample_keys.max()
+            chunk, keys = chunk[candidates], keys[candidates]
+        sample = chunk if sample is None else pd.concat([sample, chunk])
+        sample_keys = np.concatenate([sample_keys, keys])
+        if len(sample_keys) > sample_size:
+            keep = np.argpartition(sample_keys, sample_size)[:sample_size]
+            sample, sample_keys = sample.iloc[keep], sample_keys[keep]
+
+    return {'rows': rows, 'columns': statistics, 'sample': sample}
+
+
+def _combined_dtype(dtypes: set[str]) -> str:
+    if not dtypes:
+        return 'float64'
+    if len(dtypes) == 1:
+        return next(iter(dtypes))
+    if dtypes <= {'int64', 'float64'}:
+        return 'float64'
+    return 'object'
+
+
+def infer_file_schema(path: str, sample_size: int = 10_000, chunksize: int = 100_000, max_workers: Optional[int] = None, seed: int = 0, file_format: Optional[dict] = None) -> tuple[pa.DataFrameSchema, pd.DataFrame]:
+    """
+    Infer the schema of the upload at path, read as file_format (sniffed when None), the way pandera.infer_schema would
+    from the whole file, without loading it: dtypes, nullability and min/max checks come from aggregates streamed over
+    every row, and text columns with few distinct values get the allowed values as an isin check.
+
+    The columns are split between max_workers processes (one per CPU by default), each parsing only its own columns.
+    Also returns a uniform random sample of sample_size rows of the file.
+    """
+    file_format = file_format or sniff_format(path)
+    columns = read_header(path, file_format)
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(columns)))
+    groups = [group.tolist() for group in np.array_split(np.arange(len(columns)), max_workers)]
+    # Spawned, the calling process may be running threads
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        results = list(executor.map(_column_group_statistics, repeat(path), repeat(file_format), groups, repeat(chunksize), repeat(sample_size), repeat(seed)))
+
+    rows = results[0]['rows']
+    statistics = {column: stats for result in results for column, stats in result['columns'].items()}
+    schema_columns = {}
+    for column in columns:
+        column_statistics = statistics[column]
+        dtype = _combined_dtype(column_statistics['dtypes'])
+        checks = None
+        if column_statistics['min'] is not None and dtype in ('int64', 'float64'):
+            checks = [pa.Check.greater_than_or_equal_to(column_statistics['min']), pa.Check.less_than_or_equal_to(column_statistics['max'])]
+        elif dtype == 'object' and column_statistics['values'] and len(column_statistics['values']) * 2 <= rows:
+            checks = [pa.Check.isin(sorted(column_statistics['values'], key=str))]
+        schema_columns[column] = pa.Column(dtype, checks=checks, nullable=column_statistics['nullable'])
+
+    schema = pa.DataFrameSchema(
+        columns=schema_columns,
+        # What pandera infers for the RangeIndex the whole file would be read with
+        index=pa.Index('int64', checks=[pa.Check.greater_than_or_equal_to(0), pa.Check.less_than_or_equal_to(rows - 1)] if rows else None, nullable=False),
+        coerce=True,
+    )
+    samples = [result['sample'] for result in results if result['sample'] is not None]
+    sample = pd.concat(samples, axis=1)[columns].sort_index() if samples else pd.DataFrame(columns=columns)
+    return schema, sample
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import pandera
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Schema
+
+# Parsed schemas kept per process, the least recently used is dropped first
+SCHEMA_REGISTRY_SIZE = getattr(settings, "SCHEMA_REGISTRY_SIZE", 256)
+
+
+class RegisteredSchema:
+    """
+    The parsed form of a Schema row: its pandera schema compiled to a DataFrameSchema, its categories and descriptions.
+    """
+
+    def __init__(self, schema: Schema, content_hash: str):
+        self.id = schema.id
+        self.content_hash = content_hash
+        self.dataframe_schema = pandera.DataFrameSchema.from_json(schema.pandera_schema)
+        self.categories = json.loads(schema.categories) if schema.categories else {}
+        self.description_dict = schema.description_dict
+
+
+_registry: OrderedDict[tuple[int, str], RegisteredSchema] = OrderedDict()
+_registry_lock = threading.Lock()
+
+
+def schema_content_hash(schema: Schema) -> str:
+    # Hashed once per instance, the hash is dropped when the instance is saved
+    content_hash = getattr(schema, '_content_hash', None)
+    if content_hash is None:
+        content_hash = hashlib.sha256(
+            json.dumps([schema.pandera_schema, schema.categories, schema.description_dict], sort_keys=True).encode()
+        ).hexdigest()
+        schema._content_hash = content_hash
+    return content_hash
+
+
+def get_schema(schema: Schema) -> RegisteredSchema:
+    """
+    Return the parsed form of schema, parsing it only the first time this process sees this version of the row.
+
+    Entries are keyed by the row's id and a hash of its content, so a row saved by another process is parsed again
+    as soon as it is loaded here, without waiting for an invalidation. At most SCHEMA_REGISTRY_SIZE entries are kept.
+    """
+    key = (schema.id, schema_content_hash(schema))
+    with _registry_lock:
+        registered = _registry.get(key)
+        if registered is not None:
+            _registry.move_to_end(key)
+            return registered
+    registered = RegisteredSchema(schema, key[1])
+    with _registry_lock:
+        _registry[key] = registered
+        while len(_registry) > SCHEMA_REGISTRY_SIZE:
+            _registry.popitem(last=False)
+    return registered
+
+
+def invalidate_schema(schema_id: int) -> None:
+    with _registry_lock:
+        for key in [key for key in _registry if key[0] == schema_id]:
+            del _registry[key]
+
+
+def warm_schema_registry() -> int:
+    """
+    Parse every Schema ahead of the first request that needs it. Returns the number of schemas parsed.
+    """
+    schemas = list(Schema.objects.all())
+    for schema in schemas:
+        get_schema(schema)
+    return len(schemas)
+
+
+@receiver(post_save, sender=Schema)
+@receiver(post_delete, sender=Schema)
+def _invalidate_saved_schema(sender, instance, **kwargs):
+    instance.__dict__.pop('_content_hash', None)
+    invalidate_schema(instance.id)
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from typing import Iterator
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+# Storages without local paths, e.g. S3, get the files pandas and pyarrow read copied here, and new files written here
+# before they are uploaded
+STORAGE_CACHE_DIR = getattr(settings, 'STORAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'data-mapper-storage'))
+
+
+def has_local_paths() -> bool:
+    try:
+        default_storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+def _cache_path(name: str) -> str:
+    return os.path.join(STORAGE_CACHE_DIR, name)
+
+
+def local_path(name: str) -> str:
+    """
+    A local path the stored file name can be read from: the file itself when the storage keeps files on local disk,
+    otherwise a copy downloaded on first use. Stored files are never rewritten in place, so copies stay valid.
+    """
+    if has_local_paths():
+        return default_storage.path(name)
+    path = _cache_path(name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Downloaded aside and moved in place, so a concurrent reader never sees a partial copy
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with default_storage.open(name, 'rb') as stored_file, open(tmp_path, 'wb') as local_file:
+            shutil.copyfileobj(stored_file, local_file)
+        os.replace(tmp_path, path)
+    return path
+
+
+def working_path(name: str) -> str:
+    # Where to write a new file to be stored as name, call publish once it is written
+    path = default_storage.path(name) if has_local_paths() else _cache_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def publish(name: str) -> None:
+    # Upload the file written to working_path(name). Files written on local storage are stored already
+    if has_local_paths():
+        return
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    with open(_cache_path(name), 'rb') as local_file:
+        stored_name = default_storage.save(name, File(local_file))
+    if stored_name != name:
+        raise RuntimeError(f'{name} was stored as {stored_name}')
+
+
+def stored_name(path: str) -> str:
+    # Inverse of local_path
+    root = default_storage.path('') if has_local_paths() else STORAGE_CACHE_DIR
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def exists(name: str) -> bool:
+    return default_storage.exists(name)
+
+
+def delete(name: str) -> None:
+    default_storage.delete(name)
+    if not has_local_paths() and os.path.exists(_cache_path(name)):
+        os.remove(_cache_path(name))
+
+
+def iter_stored_files(directory: str) -> Iterator[tuple[str, float]]:
+    """
+    The name and age in seconds of every file stored under directory, not recursively.
+    """
+    try:
+        _, file_names = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for file_name in file_names:
+        name = f'{directory}/{file_name}'
+        yield name, now - default_storage.get_modified_time(name).timestamp()
+
+
+def prune_local_copies(max_age: float) -> int:
+    """
+    Remove the local copies of stored files not modified for max_age seconds. Returns the number of copies removed.
+    """
+    if has_local_paths() or not os.path.isdir(STORAGE_CACHE_DIR):
+        return 0
+    removed = 0
+    cutoff = time.time() - max_age
+    for directory, _, file_names in os.walk(STORAGE_CACHE_DIR):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    return removed
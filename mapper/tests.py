@@ -1,3 +1,735 @@
-from django.test import TestCase
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pandera as pa
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import column_store
+from .forms import CreateSchemaForm
+from .formulas import compile_formula
+from .frames import FrameWriter, load_frame
+from . import helpers
+from .helpers import categorize_series, data_quality_report, files_fingerprint, generate_column_code, mapping_plan_hash
+from .jobs import JOB_HANDLERS, JOB_MAX_ATTEMPTS, JOB_STALE_AFTER, claim_next_job, enqueue, run_job
+from .joins import infer_join_plan
+from .llm_cache import BaseCacheBackend, DiskCacheBackend, DjangoCacheBackend, LLMResponseCache
+from .models import Job, PipelineRun, Schema
+from .profiling import stage
+from .retention import collect_garbage
+from .sandbox import Sandbox, SandboxError, SandboxTimeout
+from . import schema_registry, storage
+
+
+class InferJoinPlanTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_csv(self, name: str, df: pd.DataFrame) -> str:
+        path = os.path.join(self.directory.name, f'{name}.csv')
+        df.to_csv(path, index=False)
+        return path
+
+    def orders_and_customers(self):
+        rng = np.random.default_rng(0)
+        customers = pd.DataFrame({'cust_id': np.arange(1, 501), 'name': [f'Customer {i}' for i in range(1, 501)]})
+        orders = pd.DataFrame({
+            'order_id': np.arange(10_000, 12_000),
+            # Small integers, all of them customer ids as well
+            'qty': rng.integers(1, 30, 2000),
+            'cust': rng.integers(1, 501, 2000),
+        })
+        return {'orders_df': self.write_csv('orders', orders), 'customers_df': self.write_csv('customers', customers)}
+
+    def test_joins_on_the_key_not_on_a_measure(self):
+        plan = infer_join_plan(self.orders_and_customers())
+
+        self.assertEqual(plan['base'], 'orders_df')
+        self.assertEqual(len(plan['steps']), 1)
+        step = plan['steps'][0]
+        self.assertEqual((step['left_column'], step['right'], step['right_column']), ('cust', 'customers_df', 'cust_id'))
+
+    def test_too_few_shared_values_are_not_joined(self):
+        lookup = pd.DataFrame({'code': ['a', 'b', 'c'], 'label': ['A', 'B', 'C']})
+        facts = pd.DataFrame({'code': ['a', 'b', 'c', 'a'], 'value': [1, 2, 3, 4]})
+
+        self.assertIsNone(infer_join_plan({'facts_df': self.write_csv('facts', facts), 'lookup_df': self.write_csv('lookup', lookup)}))
+
+    def test_ambiguous_keys_are_not_joined(self):
+        ids = np.arange(1000, 1500)
+        # Two lookup columns holding the same values, neither named like the column joined from
+        lookup = pd.DataFrame({'account': ids, 'ledger': ids})
+        facts = pd.DataFrame({'reference': np.resize(ids, 2000)})
+
+        self.assertIsNone(infer_join_plan({'facts_df': self.write_csv('facts', facts), 'lookup_df': self.write_csv('lookup', lookup)}))
+
+    def test_single_file_is_not_joined(self):
+        self.assertIsNone(infer_join_plan({'orders_df': self.orders_and_customers()['orders_df']}))
+
+
+class FrameWriterTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'frame.parquet')
+
+    def write(self, *frames: pd.DataFrame) -> pd.DataFrame:
+        with FrameWriter(self.path) as writer:
+            for df in frames:
+                writer.write(df)
+        return load_frame(self.path)
+
+    def test_column_missing_in_the_first_chunk_takes_its_type_from_later_ones(self):
+        df = self.write(
+            pd.DataFrame({'id': [1, 2], 'amount': [None, None]}),
+            pd.DataFrame({'id': [3, 4], 'amount': [1.5, 2.5]}),
+        )
+
+        self.assertEqual(df['id'].tolist(), [1, 2, 3, 4])
+        self.assertTrue(df['amount'].isna()[:2].all())
+        self.assertEqual(df['amount'][2:].tolist(), [1.5, 2.5])
+
+    def test_integers_and_floats_are_written_as_floats(self):
+        df = self.write(
+            pd.DataFrame({'amount': [None, None], 'quantity': [1, 2]}),
+            pd.DataFrame({'amount': [1.0, 2.0], 'quantity': [1.5, 2.5]}),
+        )
+
+        self.assertEqual(df['quantity'].tolist(), [1.0, 2.0, 1.5, 2.5])
+
+    def test_floats_are_not_truncated_into_an_integer_column(self):
+        with self.assertRaises(ValueError):
+            self.write(
+                pd.DataFrame({'quantity': [1, 2]}),
+                pd.DataFrame({'quantity': [1.5, 2.5]}),
+            )
+
+    def test_integral_floats_fit_an_integer_column(self):
+        df = self.write(
+            pd.DataFrame({'quantity': [1, 2]}),
+            pd.DataFrame({'quantity': [3.0, None]}),
+        )
+
+        self.assertEqual(df['quantity'].tolist()[:3], [1, 2, 3])
+        self.assertTrue(pd.isna(df['quantity'].iloc[3]))
+
+    def test_column_never_filled_is_written_as_text(self):
+        df = self.write(pd.DataFrame({'note': [None, None]}), pd.DataFrame({'note': [None]}))
+
+        self.assertEqual(len(df), 3)
+        self.assertTrue(df['note'].isna().all())
+
+
+class SandboxTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # One worker, so every run after a crash is served by the worker that replaced it
+        cls.sandbox = Sandbox(size=1, timeout=30, cpu_seconds=30, memory_bytes=None)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sandbox._idle.get().kill()
+        super().tearDownClass()
+
+    def assertRecovers(self):
+        df = self.sandbox.execute("df = frame.assign(b=frame['a'] * 2)", {'frame': pd.DataFrame({'a': [1, 2]})})
+        self.assertEqual(df['b'].tolist(), [2, 4])
+
+    def test_runs_code_on_frames(self):
+        self.assertRecovers()
+
+    def test_error_in_the_code_is_reported(self):
+        with self.assertRaisesMessage(SandboxError, 'ZeroDivisionError'):
+            self.sandbox.execute('df = 1 / 0')
+        self.assertRecovers()
+
+    def test_worker_dying_during_a_run_is_replaced(self):
+        with self.assertRaises(SandboxError):
+            self.sandbox.execute('import os\nos._exit(1)')
+        self.assertRecovers()
+
+    def test_worker_running_past_the_timeout_is_replaced(self):
+        with self.assertRaises(SandboxTimeout):
+            self.sandbox.execute('while True:\n    pass', timeout=1)
+        self.assertRecovers()
+
+    def test_worker_killed_while_idle_is_replaced(self):
+        worker = self.sandbox._idle.get()
+        worker.process.kill()
+        worker.process.join()
+        self.sandbox._idle.put(worker)
+        self.assertRecovers()
+
+
+class JobTests(TestCase):
+    def setUp(self):
+        handlers = mock.patch.dict(JOB_HANDLERS, {
+            'succeed': self.succeed,
+            'fail': lambda job: 1 / 0,
+            'fail_in_sandbox': self.fail_in_sandbox,
+        })
+        handlers.start()
+        self.addCleanup(handlers.stop)
+
+    @staticmethod
+    def succeed(job):
+        with stage('exec'):
+            return {'echo': job.payload['value']}
+
+    @staticmethod
+    def fail_in_sandbox(job):
+        raise SandboxError('Traceback (most recent call last):\n  File "<string>", line 1, in <module>\nKeyError: \'amount\'')
+
+    def test_jobs_are_claimed_oldest_first_and_once(self):
+        first = enqueue('succeed', value=1)
+        second = enqueue('succeed', value=2)
+
+        self.assertEqual(claim_next_job().id, first.id)
+        self.assertEqual(claim_next_job().id, second.id)
+        self.assertIsNone(claim_next_job())
+        first.refresh_from_db()
+        self.assertEqual((first.state, first.attempts), (Job.RUNNING, 1))
+        self.assertIsNotNone(first.heartbeat_at)
+
+    def test_succeeded_job_stores_its_result(self):
+        enqueue('succeed', value=3)
+
+        job = run_job(claim_next_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.SUCCEEDED)
+        self.assertEqual(job.result, {'echo': 3})
+        self.assertEqual(job.progress, 1)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_failed_job_stores_a_message_not_the_traceback(self):
+        enqueue('fail')
+
+        with self.assertLogs('mapper.jobs', 'ERROR') as logs:
+            job = run_job(claim_next_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.FAILED)
+        self.assertNotIn('Traceback', job.error)
+        self.assertIn(str(job.id), job.error)
+        self.assertIn('ZeroDivisionError', logs.output[0])
+
+    def test_generated_code_errors_are_summed_up(self):
+        enqueue('fail_in_sandbox')
+
+        with self.assertLogs('mapper.jobs', 'ERROR'):
+            job = run_job(claim_next_job())
+
+        self.assertEqual(job.error, "The generated code failed: KeyError: 'amount'")
+
+    def orphan(self, job: Job, attempts: int) -> None:
+        stale = timezone.now() - timedelta(seconds=JOB_STALE_AFTER + 60)
+        Job.objects.filter(id=job.id).update(state=Job.RUNNING, started_at=stale, heartbeat_at=stale, attempts=attempts)
+
+    def test_orphaned_job_is_claimed_again(self):
+        job = enqueue('succeed', value=4)
+        self.orphan(job, attempts=1)
+
+        claimed = claim_next_job()
+
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.attempts, 2)
+
+    def test_job_orphaned_too_often_is_failed(self):
+        job = enqueue('succeed', value=5)
+        self.orphan(job, attempts=JOB_MAX_ATTEMPTS)
+
+        self.assertIsNone(claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.FAILED)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_running_job_with_a_recent_heartbeat_is_left_alone(self):
+        enqueue('succeed', value=6)
+        job = claim_next_job()
+
+        self.assertIsNone(claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.RUNNING)
+
+    def test_stage_timings_are_stored_with_the_job(self):
+        enqueue('succeed', value=7)
+
+        job = run_job(claim_next_job())
+
+        job.refresh_from_db()
+        self.assertEqual(set(job.timings), {'job', 'exec'})
+        self.assertEqual(job.timings['exec']['count'], 1)
+
+    @override_settings(DEBUG=True)
+    def test_histogram_reports_the_stages_of_jobs(self):
+        enqueue('succeed', value=8)
+        run_job(claim_next_job())
+
+        report = self.client.get(reverse('profiling_histogram')).json()
+
+        self.assertEqual(report['jobs']['succeed']['exec']['count'], 1)
+
+
+class UploadFormatTests(SimpleTestCase):
+    def test_legacy_excel_is_rejected_at_upload(self):
+        workbook = SimpleUploadedFile('orders.xls', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' + bytes(504))
+
+        form = CreateSchemaForm({'name': 'Orders'}, {'example_dataset': workbook})
+
+        self.assertFalse(form.is_valid())
+        self.assertIn('.xls', form.errors['example_dataset'][0])
+
+    def test_csv_is_accepted_at_upload(self):
+        form = CreateSchemaForm({'name': 'Orders'}, {'example_dataset': SimpleUploadedFile('orders.csv', b'id,qty\n1,2\n')})
+
+        self.assertTrue(form.is_valid())
+
+
+class CompiledPlanKeyTests(SimpleTestCase):
+    frames = {'orders_df': pd.DataFrame({'order_id': [1], 'cust': [2]}), 'customers_df': pd.DataFrame({'cust_id': [2]})}
+    join_plan = {'base': 'orders_df', 'steps': [{'left': 'orders_df', 'left_column': 'cust', 'right': 'customers_df', 'right_column': 'cust_id', 'coverage': 1.0}]}
+
+    def test_join_plan_changes_the_fingerprint(self):
+        other_join = {**self.join_plan, 'steps': [{**self.join_plan['steps'][0], 'left_column': 'order_id'}]}
+
+        fingerprints = {files_fingerprint(self.frames), files_fingerprint(self.frames, self.join_plan), files_fingerprint(self.frames, other_join)}
+
+        self.assertEqual(len(fingerprints), 3)
+
+    def test_fingerprint_ignores_key_order(self):
+        reordered = {'steps': self.join_plan['steps'], 'base': 'orders_df'}
+
+        self.assertEqual(files_fingerprint(self.frames, self.join_plan), files_fingerprint(self.frames, reordered))
+
+    def test_corrected_plan_text_changes_the_plan_hash(self):
+        self.assertNotEqual(
+            mapping_plan_hash({'customer': 'customers_df name'}),
+            mapping_plan_hash({'customer': 'customers_df name, title cased'}),
+        )
+
+
+class SchemaRegistryTests(TestCase):
+    def create_schema(self, name: str) -> Schema:
+        pandera_schema = pa.DataFrameSchema({'amount': pa.Column(float)}).to_json()
+        return Schema.objects.create(name=name, description_dict={'amount': 'Amount'}, pandera_schema=pandera_schema, categories='{}')
+
+    def test_schema_is_parsed_once(self):
+        schema = self.create_schema('Orders')
+
+        self.assertIs(schema_registry.get_schema(schema), schema_registry.get_schema(Schema.objects.get(id=schema.id)))
+
+    def test_saved_schema_is_parsed_again(self):
+        schema = self.create_schema('Orders')
+        registered = schema_registry.get_schema(schema)
+
+        schema.categories = '{"amount": ["low", "high"]}'
+        schema.save()
+
+        self.assertIsNot(schema_registry.get_schema(schema), registered)
+        self.assertEqual(schema_registry.get_schema(schema).categories, {'amount': ['low', 'high']})
+
+    def test_least_recently_used_schemas_are_dropped(self):
+        schemas = [self.create_schema(f'Schema {i}') for i in range(3)]
+
+        with mock.patch.object(schema_registry, 'SCHEMA_REGISTRY_SIZE', 2):
+            first = schema_registry.get_schema(schemas[0])
+            schema_registry.get_schema(schemas[1])
+            schema_registry.get_schema(schemas[0])
+            schema_registry.get_schema(schemas[2])
+
+            self.assertIs(schema_registry.get_schema(schemas[0]), first)
+            self.assertEqual({schema_id for schema_id, _ in schema_registry._registry}, {schemas[0].id, schemas[2].id})
+
+
+class ColumnStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Stored columns go to a throwaway media root, and the code runs in process
+        media = override_settings(MEDIA_ROOT=os.path.join(directory.name, 'media'), SANDBOX_ENABLED=False)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.path = os.path.join(directory.name, 'orders.csv')
+        pd.DataFrame({'qty': [1, 2, 3], 'price': [1.5, 2.0, 2.5]}).to_csv(self.path, index=False)
+        run_code = mock.patch.object(column_store, 'run_code', side_effect=column_store.run_code)
+        self.run_code = run_code.start()
+        self.addCleanup(run_code.stop)
+
+    def materialize(self, column_code):
+        sources = {'orders_df': column_store.source_identity(self.path)}
+        return column_store.materialize_columns(column_code, sources, lambda variable: pd.read_csv(self.path))
+
+    def executed_code(self) -> list[str]:
+        codes = [call.args[0] for call in self.run_code.call_args_list]
+        self.run_code.reset_mock()
+        return codes
+
+    def test_only_the_edited_column_is_run_again(self):
+        plan = {'quantity': "df['quantity'] = orders_df['qty']", 'total': "df['total'] = orders_df['qty'] * orders_df['price']"}
+        self.materialize(plan)
+        self.assertEqual(self.executed_code(), ["\n".join(plan.values())])
+
+        edited = {**plan, 'quantity': "df['quantity'] = orders_df['qty'] * 10"}
+        df, keys = self.materialize(edited)
+
+        self.assertEqual(self.executed_code(), [edited['quantity']])
+        self.assertEqual(df['quantity'].tolist(), [10, 20, 30])
+        self.assertEqual(df['total'].tolist(), [1.5, 4.0, 7.5])
+        self.assertEqual(keys['total'], self.materialize(plan)[1]['total'])
+
+    def test_touched_source_invalidates_every_column(self):
+        plan = {'quantity': "df['quantity'] = orders_df['qty']", 'total': "df['total'] = orders_df['qty'] * orders_df['price']"}
+        self.materialize(plan)
+        self.executed_code()
+
+        pd.DataFrame({'qty': [4, 5, 6, 7], 'price': [1.0, 1.0, 1.0, 1.0]}).to_csv(self.path, index=False)
+        df, _ = self.materialize(plan)
+
+        self.assertEqual(self.executed_code(), ["\n".join(plan.values())])
+        self.assertEqual(df['total'].tolist(), [4.0, 5.0, 6.0, 7.0])
+
+    def test_new_modification_time_invalidates_the_columns(self):
+        plan = {'quantity': "df['quantity'] = orders_df['qty']"}
+        self.materialize(plan)
+        self.executed_code()
+
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.materialize(plan)
+
+        self.assertEqual(self.executed_code(), [plan['quantity']])
+
+
+class CompileFormulaTests(SimpleTestCase):
+    frames = {
+        'file1_df': pd.DataFrame({'first_name': ['Ada', 'Alan', None], 'last_name': ['Lovelace', None, None], 'qty': [2, 3, 4]}),
+        'file2_df': pd.DataFrame({'price': [1.5, 2.0, 2.5]}),
+    }
+
+    def evaluate(self, formula: str) -> pd.Series:
+        expression = compile_formula(formula, self.frames)
+        self.assertIsNotNone(expression, formula)
+        return eval(expression, {'pd': pd, **self.frames})
+
+    def test_single_reference(self):
+        self.assertEqual(compile_formula('file1.qty', self.frames), "file1_df['qty']")
+        self.assertEqual(compile_formula('formula: `file1.csv.qty`', self.frames), "file1_df['qty']")
+
+    def test_references_separated_by_spaces_are_concatenated(self):
+        names = self.evaluate('file1.first_name file1.last_name')
+
+        self.assertEqual(names[:2].tolist(), ['Ada Lovelace', 'Alan'])
+        self.assertTrue(pd.isna(names[2]))
+
+    def test_arithmetic_on_numeric_columns(self):
+        self.assertEqual(self.evaluate('file1.qty + 1').tolist(), [3, 4, 5])
+        self.assertEqual(self.evaluate('file1.qty - file2.price').tolist(), [0.5, 1.0, 1.5])
+        self.assertEqual(self.evaluate('file1.qty * file2.price').tolist(), [3.0, 6.0, 10.0])
+        self.assertEqual(self.evaluate('(file1.qty + 2) / 2').tolist(), [2.0, 2.5, 3.0])
+
+    def test_everything_else_is_left_to_the_llm(self):
+        for formula in [
+            'file1.first_name + file1.last_name',
+            'file3.qty',
+            'file1.quantity',
+            'parsed from file1.first_name',
+            'file1.first_name, file1.last_name',
+            'file1.qty ** 2',
+            'the total of the order',
+        ]:
+            with self.subTest(formula=formula):
+                self.assertIsNone(compile_formula(formula, self.frames))
+
+
+class StubbedLLMTestCase(SimpleTestCase):
+    """
+    Answers from a throwaway LLM cache and counts every text as 10 tokens, so budgets are easy to reason about.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.llm_cache = LLMResponseCache(DiskCacheBackend(directory.name))
+        for target, value in (('get_llm_cache', lambda: self.llm_cache), ('count_tokens', lambda text, model='gpt-3.5-turbo': 10)):
+            patcher = mock.patch.object(helpers, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class GenerateColumnCodeTests(StubbedLLMTestCase):
+    requests = {column: f'The formula to parse the column `{column}` is: orders.{column}' for column in ('a', 'b', 'c')}
+
+    def setUp(self):
+        super().setUp()
+        self.prompts = []
+        llm = mock.Mock(model_name='gpt-3.5-turbo', model_kwargs={'temperature': 0.0}, generate=self.generate)
+        patcher = mock.patch.object(helpers, 'llm', llm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def generate(self, prompts):
+        prompt = prompts[0]
+        self.prompts.append(prompt)
+        if prompt.startswith('single '):
+            column = prompt.removeprefix('single ')
+            answer = f"df['{column}'] = orders_df['{column}']"
+        else:
+            # a is answered correctly, b with code that doesn't parse, c not at all
+            answer = 'Answer: ' + json.dumps({'a': "df['a'] = orders_df['a']", 'b': "df['b'] = orders_df['b'"})
+        return mock.Mock(generations=[[mock.Mock(text=answer)]], llm_output={'token_usage': {}})
+
+    def generate_code(self, batch_token_budget: int) -> dict[str, str]:
+        return generate_column_code('Batch prompt\n', self.requests, lambda column: f'single {column}', batch_token_budget=batch_token_budget, max_concurrency=1)
+
+    def test_invalid_and_missing_columns_are_generated_again_one_by_one(self):
+        column_code = self.generate_code(batch_token_budget=1000)
+
+        self.assertEqual(column_code, {column: f"df['{column}'] = orders_df['{column}']" for column in ('a', 'b', 'c')})
+        self.assertEqual(len([prompt for prompt in self.prompts if not prompt.startswith('single ')]), 1)
+        self.assertEqual(sorted(prompt for prompt in self.prompts if prompt.startswith('single ')), ['single b', 'single c'])
+
+    def test_requests_over_the_budget_are_split_into_batches(self):
+        # 10 tokens of shared prompt and 10 per column: two columns per batch
+        self.generate_code(batch_token_budget=30)
+
+        batches = [prompt for prompt in self.prompts if not prompt.startswith('single ')]
+        self.assertEqual(len(batches), 2)
+        self.assertIn('column `a`', batches[0])
+        self.assertIn('column `b`', batches[0])
+        self.assertIn('column `c`', batches[1])
+
+    def test_generated_code_is_cached_per_column(self):
+        self.generate_code(batch_token_budget=1000)
+        self.prompts.clear()
+
+        self.generate_code(batch_token_budget=1000)
+
+        self.assertEqual(self.prompts, [])
+
+
+class CategorizeSeriesTests(StubbedLLMTestCase):
+    categories = ['small', 'large']
+
+    def setUp(self):
+        super().setUp()
+        self.seen = []
+        model = mock.Mock(map_categories=self.map_categories)
+        patcher = mock.patch.object(helpers, 'marvin_data', model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sizes = np.random.default_rng(0).choice(['S', 'M', 'XL'], 10_000).astype(object)
+        sizes[::7] = np.nan
+        self.series = pd.Series(sizes, name='size')
+
+    def map_categories(self, data, categories):
+        self.seen.extend(data)
+        return ['large' if value == 'XL' else 'small' for value in data]
+
+    def test_each_distinct_value_is_sent_once(self):
+        categorized = categorize_series(self.series, self.categories, cache_namespace='1/size', max_concurrency=1)
+
+        self.assertEqual(sorted(self.seen), ['M', 'S', 'XL'])
+        self.assertEqual(len(categorized), 10_000)
+        expected = self.series.map({'S': 'small', 'M': 'small', 'XL': 'large'})
+        self.assertTrue(categorized.isna().equals(self.series.isna()))
+        self.assertEqual(categorized.dropna().tolist(), expected.dropna().tolist())
+
+    def test_categories_are_cached_per_schema_column_and_categories(self):
+        categorize_series(self.series, self.categories, cache_namespace='1/size')
+        self.seen.clear()
+
+        categorize_series(self.series, self.categories, cache_namespace='1/size')
+        self.assertEqual(self.seen, [])
+
+        categorize_series(self.series, ['small', 'medium', 'large'], cache_namespace='1/size')
+        self.assertEqual(sorted(self.seen), ['M', 'S', 'XL'])
+
+
+class LLMCacheBackendTests(SimpleTestCase):
+    def disk_backend(self, **options) -> DiskCacheBackend:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        backend = DiskCacheBackend(directory.name, **options)
+        self.addCleanup(backend._cache.close)
+        return backend
+
+    def test_backends_must_implement_every_method(self):
+        with self.assertRaises(TypeError):
+            BaseCacheBackend()
+
+    def test_disk_backend_counts_hits_and_misses(self):
+        backend = self.disk_backend()
+        backend.set('answer', '"42"')
+
+        self.assertEqual(backend.get('answer'), '"42"')
+        self.assertIsNone(backend.get('question'))
+        self.assertEqual({key: backend.stats()[key] for key in ('hits', 'misses', 'entries')}, {'hits': 1, 'misses': 1, 'entries': 1})
+
+    def test_disk_backend_expires_entries(self):
+        backend = self.disk_backend(timeout=1)
+        backend.set('answer', '"42"')
+
+        time.sleep(1.1)
+
+        self.assertIsNone(backend.get('answer'))
+
+    def test_disk_backend_evicts_the_least_recently_used_entry(self):
+        value = 'x' * 40_000
+        # Room for an empty cache and three values, evicting one entry at a time once full
+        backend = self.disk_backend(size_limit=32 * 1024 + 130_000, cull_limit=1)
+        for key in ('a', 'b', 'c'):
+            backend.set(key, value)
+        backend.get('a')
+
+        backend.set('d', value)
+
+        self.assertIsNotNone(backend.get('a'))
+        self.assertIsNone(backend.get('b'))
+        self.assertIsNotNone(backend.get('d'))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'llm-cache-tests'}})
+    def test_django_backend_counts_hits_and_misses_and_expires_entries(self):
+        backend = DjangoCacheBackend(timeout=1)
+        backend.clear()
+        backend.set('answer', '"42"')
+
+        self.assertEqual(backend.get('answer'), '"42"')
+        self.assertIsNone(backend.get('question'))
+        time.sleep(1.1)
+        self.assertIsNone(backend.get('answer'))
+
+        self.assertEqual(backend.stats(), {'hits': 1, 'misses': 2})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'data-quality-tests'}})
+class DataQualityReportTests(SimpleTestCase):
+    schema = pa.DataFrameSchema({
+        'amount': pa.Column(float, pa.Check.ge(0)),
+        'code': pa.Column(str, pa.Check.isin(['A', 'B'])),
+    })
+
+    def setUp(self):
+        cache.clear()
+
+    def frame(self, rows: int = 10) -> pd.DataFrame:
+        df = pd.DataFrame({'amount': np.arange(rows, dtype=float), 'code': ['A'] * rows})
+        df.loc[[2, 5], 'amount'] = -1.0
+        df.loc[[3, 7, 8], 'code'] = 'Z'
+        return df
+
+    def test_failures_are_reported_per_column(self):
+        report = data_quality_report(self.frame(), self.schema)
+
+        self.assertEqual(set(report), {'amount', 'code'})
+        self.assertEqual(report['amount']['failures'], 2)
+        self.assertEqual(report['amount']['sample_rows'], [2, 5])
+        self.assertEqual(report['amount']['sample_values'], ['-1.0', '-1.0'])
+        self.assertEqual(report['code']['failures'], 3)
+        self.assertEqual(report['code']['sample_rows'], [3, 7, 8])
+        self.assertFalse(report['code']['sampled'])
+
+    def test_long_frames_are_validated_on_a_sample(self):
+        df = pd.DataFrame({'amount': -np.ones(1000), 'code': ['A'] * 1000})
+
+        report = data_quality_report(df, self.schema, sample_rows=100)
+
+        self.assertEqual(report['amount']['failures'], 100)
+        self.assertTrue(report['amount']['sampled'])
+
+    def test_reports_are_cached_by_frame_content(self):
+        data_quality_report(self.frame(), self.schema)
+
+        with mock.patch.object(helpers, 'frame_content_hash', wraps=helpers.frame_content_hash) as content_hash, \
+                mock.patch.object(pa.DataFrameSchema, 'validate', autospec=True, side_effect=pa.DataFrameSchema.validate) as validate:
+            cached = data_quality_report(self.frame(), self.schema)
+            self.assertEqual(validate.call_count, 0)
+            self.assertEqual(content_hash.call_count, 1)
+
+            changed = self.frame()
+            changed.loc[0, 'amount'] = -2.0
+            report = data_quality_report(changed, self.schema)
+            self.assertEqual(validate.call_count, 1)
+
+        self.assertEqual(cached['amount']['failures'], 2)
+        self.assertEqual(report['amount']['failures'], 3)
+
+
+class PathlessStorage(FileSystemStorage):
+    """
+    Stand-in for a remote storage such as S3: files are kept on disk, but without local paths.
+    """
+
+    def path(self, name):
+        # FileSystemStorage finds its own files with path, nothing else may
+        if sys._getframe(1).f_globals['__name__'].startswith('django.core.files'):
+            return super().path(name)
+        raise NotImplementedError("This backend doesn't support absolute paths.")
+
+
+class PathlessStorageTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.location = os.path.join(directory.name, 'bucket')
+        storages = override_settings(STORAGES={
+            'default': {'BACKEND': 'mapper.tests.PathlessStorage', 'OPTIONS': {'location': self.location}},
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        })
+        storages.enable()
+        self.addCleanup(storages.disable)
+        cache_dir = mock.patch.object(storage, 'STORAGE_CACHE_DIR', os.path.join(directory.name, 'copies'))
+        cache_dir.start()
+        self.addCleanup(cache_dir.stop)
+
+    def store(self, name: str, content: bytes = b'data', age: float = 0) -> None:
+        with open(storage.working_path(name), 'wb') as file:
+            file.write(content)
+        storage.publish(name)
+        stored = os.path.join(self.location, name)
+        os.utime(stored, (time.time() - age, time.time() - age))
+
+
+class StorageTests(PathlessStorageTestCase):
+    def test_published_files_are_uploaded_and_read_from_local_copies(self):
+        self.assertFalse(storage.has_local_paths())
+        self.store('after_mapping/frame.parquet', b'frame')
+
+        self.assertTrue(os.path.exists(os.path.join(self.location, 'after_mapping/frame.parquet')))
+        # The copy written before the upload is gone, as on another worker
+        os.remove(storage.working_path('after_mapping/frame.parquet'))
+        path = storage.local_path('after_mapping/frame.parquet')
+
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'frame')
+        self.assertTrue(path.startswith(storage.STORAGE_CACHE_DIR))
+
+    def test_garbage_collection_keeps_referenced_and_recent_frames(self):
+        schema = Schema.objects.create(name='Orders', description_dict={}, pandera_schema={}, categories='{}')
+        PipelineRun.objects.create(schema=schema, df_name='after_mapping/referenced.parquet')
+        day = 24 * 60 * 60
+        self.store('after_mapping/referenced.parquet', age=30 * day)
+        self.store('after_mapping/orphaned.parquet', age=30 * day)
+        self.store('after_mapping/recent.parquet', age=0)
+        self.store('columns/old.parquet', age=30 * day)
+
+        deleted = collect_garbage(max_age=7 * day)
+
+        self.assertEqual((deleted['frames'], deleted['columns']), (1, 1))
+        self.assertTrue(storage.exists('after_mapping/referenced.parquet'))
+        self.assertTrue(storage.exists('after_mapping/recent.parquet'))
+        self.assertFalse(storage.exists('after_mapping/orphaned.parquet'))
+        self.assertFalse(storage.exists('columns/old.parquet'))
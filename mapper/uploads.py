@@ -0,0 +1,71 @@
+import json
+from typing import Optional
+
+import pandas as pd
+
+from .ingestion import read_table, sniff_format
+from .models import UploadedFile
+from .storage import local_path, stored_name
+
+# Number of rows read from each input file to build prompts and fingerprint its columns
+EXAMPLE_SAMPLE_ROWS = 1000
+# Number of rows shown to the LLM as examples of a file
+EXAMPLE_HEAD_ROWS = 3
+
+
+def extract_metadata(path: str, nrows: int = EXAMPLE_SAMPLE_ROWS, file_format: Optional[dict] = None) -> dict:
+    """
+    Read the first nrows rows of the upload at path and describe the file: its header, the dtypes inferred from
+    those rows, the first EXAMPLE_HEAD_ROWS rows, as data and as the markdown table prompts show, and the memory a row
+    takes once parsed.
+    """
+    sample = read_table(path, file_format, nrows=nrows)
+    head = sample.head(EXAMPLE_HEAD_ROWS)
+    return {
+        'header': [str(column) for column in sample.columns],
+        'dtypes': {str(column): str(dtype) for column, dtype in sample.dtypes.items()},
+        'head': json.loads(head.to_json(orient='split', index=False, date_format='iso')),
+        'markdown': head.to_markdown(),
+        'bytes_per_row': float(sample.memory_usage(deep=True).sum() / len(sample)) if len(sample) else 0.0,
+        'sample_rows': len(sample),
+    }
+
+
+def ensure_metadata(uploaded_file: UploadedFile) -> dict:
+    update_fields = []
+    if uploaded_file.file_format is None:
+        uploaded_file.file_format = sniff_format(local_path(uploaded_file.file.name))
+        update_fields.append('file_format')
+    if uploaded_file.metadata is None:
+        uploaded_file.metadata = extract_metadata(local_path(uploaded_file.file.name), file_format=uploaded_file.file_format)
+        update_fields.append('metadata')
+    if update_fields:
+        uploaded_file.save(update_fields=update_fields)
+    return uploaded_file.metadata
+
+
+def file_metadata(path: str) -> dict:
+    """
+    Metadata of the uploaded file whose local copy is at path, see storage.local_path. Uploads made before metadata
+    was extracted at upload time get it extracted and stored now; paths that aren't uploads are read every time.
+    """
+    uploaded_file = UploadedFile.objects.filter(file=stored_name(path)).first()
+    if uploaded_file is None:
+        return extract_metadata(path)
+    return ensure_metadata(uploaded_file)
+
+
+def file_format(path: str) -> dict:
+    """
+    How to read the uploaded file whose local copy is at path, see ingestion.sniff_format. Sniffed once per upload.
+    """
+    uploaded_file = UploadedFile.objects.filter(file=stored_name(path)).first()
+    if uploaded_file is None:
+        return sniff_format(path)
+    ensure_metadata(uploaded_file)
+    return uploaded_file.file_format
+
+
+def sample_frame(metadata: dict) -> pd.DataFrame:
+    # An empty frame with the file's columns and dtypes, enough to fingerprint the file or check a formula against it
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in metadata['dtypes'].items()})
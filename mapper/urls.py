@@ -5,10 +5,15 @@ from mapper import views
 urlpatterns = [
     path("<int:schema_id>/mapper/", views.upload_files, name="upload_files"),
     # path('mapping_correction/', views.mapping_correction, name='mapping_correction'),
-    path('<int:schema_id>/mapping_plan/', views.mapping_correction_form, name='mapping_correction'),
-    path('<int:schema_id>/generate_file/', views.generate_file, name='generate_file'),
+    path('runs/<int:run_id>/mapping_plan/', views.mapping_correction_form, name='mapping_correction'),
+    path('runs/<int:run_id>/generate_file/', views.generate_file, name='generate_file'),
     path("create_schema/", views.create_schema, name="create_schema"),
     path('save_schema/', views.save_schema, name='save_schema'),
-    path('<int:schema_id>/apply_transformations/', views.apply_transformations, name='apply_transformations'),
+    path('runs/<int:run_id>/apply_transformations/', views.apply_transformations, name='apply_transformations'),
+    path('frames/<str:frame_id>/rows/', views.frame_rows, name='frame_rows'),
+    path('jobs/<int:job_id>/', views.job_detail, name='job_detail'),
+    path('jobs/<int:job_id>/status/', views.job_status, name='job_status'),
+    path('debug/profiling/', views.profiling_histogram, name='profiling_histogram'),
+    path('debug/profiling/<str:report_id>/', views.profiling_report, name='profiling_report'),
     path('', views.schema_list, name='schema_list'),
 ]
\ No newline at end of file
@@ -1,22 +1,60 @@
 # Create your views here.
-import json
-import os
-import uuid
+import time
 
-import pandas as pd
-import pandera
 from django.conf import settings
-from django.http import FileResponse, HttpResponse, HttpResponseNotAllowed, HttpResponseRedirect
-from django.shortcuts import redirect, render
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseRedirect, JsonResponse, \
+    StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.template.response import TemplateResponse
 from django.urls import reverse
 
 from .forms import ApplyTransformationForm, CreateSchemaForm, EditSchemaForm, UploadFileForm
-from .helpers import apply_transformations_to_df, execute_mapping_plan, generate_description_dict, \
-    generate_pandera_schema, inital_data_mapping_plan, \
-    run_data_quality_checks
-from .models import Schema, UploadedFile
+from .frames import DOWNLOAD_COMPRESSIONS, count_frame_rows, frame_id, frame_name, iter_compressed, iter_frame_csv, load_frame, \
+    load_frame_window, new_frame_name, store_frame
+from .helpers import apply_transformations_to_df, run_data_quality_checks
+from .jobs import enqueue, job_histogram
+from .llm_accounting import accounting_scope, assign_job_calls
+from .models import Job, PipelineRun, Schema, UploadedFile
+from .profiling import PROFILING_HISTORY_SIZE, histogram, profile_report, stage
+from .schema_registry import get_schema
+from .storage import delete, exists, local_path
+from .uploads import ensure_metadata
+
+# Number of rows rendered per page of a DataFrame preview
+PREVIEW_PAGE_SIZE = 50
+
+
+def _frame_page_context(df_name, page):
+    df_path = local_path(df_name)
+    df = load_frame_window(df_path, page * PREVIEW_PAGE_SIZE, PREVIEW_PAGE_SIZE)
+    has_next_page = (page + 1) * PREVIEW_PAGE_SIZE < count_frame_rows(df_path)
+    return {
+        'df_header': df.columns.tolist(),
+        # Plain lists of cell values, so the template doesn't look each cell up by column name
+        'df_rows': df.astype(object).where(df.notna(), None).values.tolist(),
+        'next_page_url': f"{reverse('frame_rows', args=(frame_id(df_name),))}?page={page + 1}" if has_next_page else None,
+    }
+
+
+def render_frame_preview(df_name):
+    context = _frame_page_context(df_name, 0)
+    with stage('render'):
+        return render_to_string('mapper/dataframe.html', context)
+
+
+def frame_rows(request, frame_id):
+    # A page of rows of a stored frame, fetched by the preview table as it is scrolled
+    try:
+        df_name = frame_name(frame_id)
+        page = max(0, int(request.GET.get('page', 0)))
+    except ValueError:
+        raise Http404
+    if not exists(df_name):
+        raise Http404
+    context = _frame_page_context(df_name, page)
+    with stage('render'):
+        return render(request, 'mapper/dataframe_rows.html', context)
 
 
 def upload_files(request, schema_id):
@@ -25,12 +63,12 @@ def upload_files(request, schema_id):
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
             uploaded_files = form.save()
+            run = PipelineRun.objects.create(schema=schema)
+            run.uploaded_files.set(uploaded_files)
 
-            # Call python function to generate dictionary
-            files = [file.file.path for file in uploaded_files]
-            request.session['mapping_plan'] = inital_data_mapping_plan(files, schema.description_dict, json.loads(schema.categories))
-            request.session['uploaded_file_ids'] = [file.id for file in uploaded_files]
-            return redirect('mapping_correction', schema_id=schema_id)
+            # Plan the mapping in the background; the job page polls until the plan is ready
+            job = enqueue('plan_mapping', run_id=run.id)
+            return redirect('job_detail', job_id=job.id)
             # context = {'form': form, 'file_dict': your_python_function(uploaded_files), 'uploaded_files': uploaded_files}
             # Check if it's an HTMX request
             # if 'HTTP_HX_REQUEST' in request.META:
@@ -40,54 +78,38 @@ def upload_files(request, schema_id):
             # return render(request, 'mapper/mapping_correction.html', context)
     else:
         form = UploadFileForm()
-    return render(request, 'mapper/upload_files.html', {'form': form, 'schema_id': schema_id, 'schema': schema})
+    with stage('render'):
+        return render(request, 'mapper/upload_files.html', {'form': form, 'schema_id': schema_id, 'schema': schema})
 
 
-def mapping_correction_form(request, schema_id):
+def mapping_correction_form(request, run_id):
+    run = get_object_or_404(PipelineRun.objects.select_related('schema'), id=run_id)
     if request.method == 'POST':
         if 'next' in request.POST:
-            return HttpResponseRedirect(reverse('apply_transformations', args=(schema_id,)))
-    mapping_plan = request.session.get('mapping_plan', {})
-    uploaded_file_ids = request.session.get('uploaded_file_ids', [])
-    schema = Schema.objects.get(id=schema_id)
-    return render(request, 'mapper/mapping_correction.html', {'mapping_plan': mapping_plan, 'uploaded_file_ids': uploaded_file_ids, 'schema_id': schema_id, 'schema': schema})
+            return HttpResponseRedirect(reverse('apply_transformations', args=(run.id,)))
+    uploaded_file_ids = list(run.uploaded_files.values_list('id', flat=True))
+    with stage('render'):
+        return render(request, 'mapper/mapping_correction.html', {'mapping_plan': run.mapping_plan or {}, 'uploaded_file_ids': uploaded_file_ids, 'run': run, 'schema': run.schema})
 
 
-def generate_file(request, schema_id):
+def generate_file(request, run_id):
     if request.method == 'POST':
+        run = get_object_or_404(PipelineRun, id=run_id)
+
         # Extract mapping corrections from POST data
-        mapping_corrections = dict(request.POST)
+        mapping_corrections = request.POST.dict()
 
         # Remove the CSRF token from the mapping corrections
         mapping_corrections.pop('csrfmiddlewaretoken', None)
 
-        # For simplicity, we are just going to concatenate all files.
-        # This logic should be replaced with the actual logic for generating the final output file based on the mapping corrections.
-        uploaded_file_ids = request.session.get('uploaded_file_ids', [])
-
-        # Get the uploaded files corresponding to the IDs
-        uploaded_files = UploadedFile.objects.filter(id__in=uploaded_file_ids)
-        files = [file.file.path for file in uploaded_files]
-        schema = Schema.objects.get(id=schema_id)
-        df = execute_mapping_plan(files, mapping_corrections, schema.description_dict, json.loads(schema.categories))
-
-        # Save the DataFrame as a CSV file
-        output_file_path = f'{settings.MEDIA_ROOT}/after_mapping/{uuid.uuid4().hex}.csv'  # generate a unique filename
-        df.to_csv(output_file_path)
-
-        # Store the output file path and columns in the session
-        request.session['df_path'] = output_file_path
-        request.session['columns'] = df.columns.tolist()
+        # The corrected plan replaces the run's, the job maps the files with it and the run shows it when opened again
+        run.mapping_plan = mapping_corrections
+        run.save(update_fields=['mapping_plan', 'updated_at'])
+        job = enqueue('generate_file', run_id=run.id)
 
-        df_json = df.reset_index().to_json(orient="records")
-        df_data = json.loads(df_json)
-        df_header = df.columns.values.tolist()
-
-        # Convert the DataFrame to HTML
-        # df_html = df.to_html()
-
-        # Return the DataFrame HTML
-        return HttpResponse(render_to_string("mapper/dataframe.html", {"df_data": df_data, "df_header": df_header}))
+        # Return a placeholder that polls the job and is replaced by the preview once the file is generated
+        with stage('render'):
+            return render(request, 'mapper/job_status.html', {'job': job})
 
     else:
         return HttpResponseNotAllowed(['POST'])
@@ -144,24 +166,40 @@ def generate_file(request, schema_id):
 #         form = ApplyTransformationForm(columns=df.columns, errors=errors)
 #         return render(request, 'mapper/apply_transformations.html', {'form': form, 'schema_id': schema_id, 'dataframe_html': df.to_html()})
 
-def apply_transformations(request, schema_id):
-    # Get the path of the generated file from the session
-    df_path = request.session.get('df_path')
-
-    # Load the DataFrame from the CSV file
-    df = pd.read_csv(df_path)
-
-    # Get the schema
-    schema = Schema.objects.get(id=schema_id)
+def _download_response(df_name, compression):
+    # The CSV is only rendered here, streamed from the stored frame and compressed on the fly if asked to
+    file_name = frame_id(df_name) + '.csv'
+    content_type = 'text/csv'
+    if compression is not None:
+        extension, content_type = DOWNLOAD_COMPRESSIONS[compression]
+        file_name += extension
+    response = StreamingHttpResponse(iter_compressed(iter_frame_csv(local_path(df_name)), compression), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
+
+
+def apply_transformations(request, run_id):
+    # The run's generated frame is kept as mapped; transformations are applied to it and stored in a separate frame,
+    # so edited transformations only recompute the columns they change
+    run = get_object_or_404(PipelineRun.objects.select_related('schema'), id=run_id)
+    if not run.df_name:
+        raise Http404
+    df_name = run.df_name
+    transformed_df_name = run.transformed_df_name or None
+    if transformed_df_name is not None and not exists(transformed_df_name):
+        transformed_df_name = None
+
+    # Load the DataFrame from the stored frame
+    df = load_frame(local_path(transformed_df_name or df_name))
 
     # Check the data quality of the DataFrame
-    errors = run_data_quality_checks(df, pandera.DataFrameSchema.from_json(schema.pandera_schema))
+    registered_schema = get_schema(run.schema)
+    with stage('validate'):
+        errors = run_data_quality_checks(df, registered_schema.dataframe_schema, schema_key=registered_schema.content_hash)
 
-    # Convert the DataFrame to HTML
-    df_json = df.reset_index().to_json(orient="records")
-    df_data = json.loads(df_json)
-    df_header = df.columns.values.tolist()
-    df_html = render_to_string('mapper/dataframe.html', {'df_data': df_data, 'df_header': df_header})
+    # Render the first page of the DataFrame, the table fetches the rest while scrolling
+    df_html = render_frame_preview(transformed_df_name or df_name)
+    context = {'run': run, 'schema': run.schema, 'dataframe_html': df_html, 'download_compressions': list(DOWNLOAD_COMPRESSIONS)}
 
     if request.method == 'POST':
         # Store transformations in initial data
@@ -169,35 +207,36 @@ def apply_transformations(request, schema_id):
                                    key.startswith('transformation_')}
         form = ApplyTransformationForm(request.POST, errors=errors, initial=initial_transformations)
         if form.is_valid():
-            # Apply transformations
+            # Apply transformations. Stored frames never change, so the mapped frame's name identifies its columns
             transformations = {key.replace('transformation_', ''): value for key, value in form.cleaned_data.items()}
-            df = apply_transformations_to_df(df, transformations)
-
-            # Save the DataFrame to the CSV file
-            df.to_csv(df_path, index=False)
-            df_html = df.to_html()
+            started = time.monotonic()
+            with accounting_scope(run_id=run.id, schema_id=run.schema_id):
+                df = apply_transformations_to_df(load_frame(local_path(df_name)), transformations, base_key=df_name)
+            run.record_timing('apply_transformations', time.monotonic() - started)
+
+            # Store the transformed DataFrame as a new frame, replacing the previous transformation's
+            if transformed_df_name is not None:
+                delete(transformed_df_name)
+            transformed_df_name = new_frame_name()
+            store_frame(df, transformed_df_name)
+            run.transformed_df_name = transformed_df_name
+            run.save(update_fields=['transformed_df_name', 'timings', 'updated_at'])
+            context['dataframe_html'] = render_frame_preview(transformed_df_name)
 
             # Check if we should download the data
             if 'download' in request.POST:
-                # Create a response with the CSV file
-                response = FileResponse(open(df_path, 'rb'), content_type='text/csv')
-                response['Content-Disposition'] = f'attachment; filename="{os.path.basename(df_path)}"'
-                return response
+                compression = request.POST.get('compression') or None
+                return _download_response(transformed_df_name, compression if compression in DOWNLOAD_COMPRESSIONS else None)
         else:
             # If form is invalid, show the form with error messages
-            df_json = df.reset_index().to_json(orient="records")
-            df_data = json.loads(df_json)
-            df_header = df.columns.values.tolist()
-            df_html = render_to_string('mapper/dataframe.html', {'df_data': df_data, 'df_header': df_header})
-            request.session['df_path'] = df_path
-            return render(request, 'mapper/apply_transformations.html', {'form': form, 'dataframe_html': df_html})
+            with stage('render'):
+                return render(request, 'mapper/apply_transformations.html', {'form': form, **context})
     else:
         # For GET requests, just display the form
         form = ApplyTransformationForm(errors=errors, columns=df.columns)
 
-    request.session['df_path'] = df_path
-
-    return render(request, 'mapper/apply_transformations.html', {'form': form, 'dataframe_html': df_html})
+    with stage('render'):
+        return render(request, 'mapper/apply_transformations.html', {'form': form, **context})
 
 # def create_schema(request):
 #     if request.method == 'POST':
@@ -224,21 +263,15 @@ def create_schema(request):
     if request.method == 'POST':
         form = CreateSchemaForm(request.POST, request.FILES)
         if form.is_valid():
-            # Load the uploaded dataset into a DataFrame
-            df = pd.read_csv(form.cleaned_data['example_dataset'])
-
-            # Generate the initial description_dict and pandera_schema
-            description_dict, categories_dict = generate_description_dict(df)
-            pandera_schema = generate_pandera_schema(df)
-
-            # Initialize the EditSchemaForm with the initial data
-            edit_form = EditSchemaForm(initial={'description_dict': description_dict, 'pandera_schema': pandera_schema, 'name': form.cleaned_data['name'], 'categories': json.dumps(categories_dict)})
-
-            # Render the form for editing the schema
-            return render(request, 'mapper/edit_schema.html', {'form': edit_form})
+            # Keep the example dataset so the worker can describe it in the background
+            example_dataset = UploadedFile.objects.create(file=form.cleaned_data['example_dataset'])
+            ensure_metadata(example_dataset)
+            job = enqueue('create_schema', name=form.cleaned_data['name'], uploaded_file_id=example_dataset.id)
+            return redirect('job_detail', job_id=job.id)
     else:
         form = CreateSchemaForm()
-    return render(request, 'mapper/create_schema.html', {'form': form})
+    with stage('render'):
+        return render(request, 'mapper/create_schema.html', {'form': form})
 
 
 def save_schema(request):
@@ -249,13 +282,17 @@ def save_schema(request):
         form = EditSchemaForm(request.POST, description_dict=description_dict)
         if form.is_valid():
             # Save the schema in the database
-            form.save()
+            schema = form.save()
+            # The LLM calls that described the example dataset were made before the schema existed
+            if form.cleaned_data.get('job_id'):
+                assign_job_calls(form.cleaned_data['job_id'], schema.id)
 
             # Return a success message
             return redirect('schema_list')
         else:
             # Form is not valid, show the form with error messages
-            return render(request, 'mapper/edit_schema.html', {'form': form})
+            with stage('render'):
+                return render(request, 'mapper/edit_schema.html', {'form': form})
 
     return HttpResponseNotAllowed(['POST'])
 
@@ -264,4 +301,67 @@ def schema_list(request):
     schemas = Schema.objects.all()
 
     # Render the list of schemas
-    return render(request, 'mapper/schema_list.html', {'schemas': schemas})
+    with stage('render'):
+        return render(request, 'mapper/schema_list.html', {'schemas': schemas})
+
+
+def _job_result(request, job):
+    # Hand the result of a finished job over to the next step of the pipeline
+    if job.kind == 'create_schema':
+        # Initialize the EditSchemaForm with the initial data
+        edit_form = EditSchemaForm(initial={'description_dict': job.result['description_dict'], 'pandera_schema': job.result['pandera_schema'], 'name': job.result['name'], 'categories': job.result['categories'], 'job_id': job.id})
+        with stage('render'):
+            return render(request, 'mapper/edit_schema.html', {'form': edit_form})
+    if job.kind == 'plan_mapping':
+        return redirect('mapping_correction', run_id=job.payload['run_id'])
+    if job.kind == 'generate_file':
+        # The job stored the output frame on the run already
+        return HttpResponse(render_frame_preview(job.result['df_name']))
+    return HttpResponseBadRequest(f'Unknown job kind {job.kind}')
+
+
+def job_detail(request, job_id):
+    job = get_object_or_404(Job, id=job_id)
+    if job.state == Job.SUCCEEDED:
+        return _job_result(request, job)
+    with stage('render'):
+        return render(request, 'mapper/job.html', {'job': job})
+
+
+def job_status(request, job_id):
+    # Polled over HTMX while the job runs
+    job = get_object_or_404(Job, id=job_id)
+    if job.state == Job.SUCCEEDED:
+        if job.kind == 'generate_file':
+            # The preview replaces the polling placeholder in place
+            return _job_result(request, job)
+        response = HttpResponse()
+        response['HX-Redirect'] = reverse('job_detail', args=(job.id,))
+        return response
+    if request.headers.get('Accept') == 'application/json':
+        with stage('to_json'):
+            return JsonResponse({'id': job.id, 'kind': job.kind, 'state': job.state, 'progress': job.progress, 'error': job.error})
+    with stage('render'):
+        return render(request, 'mapper/job_status.html', {'job': job})
+
+
+def _check_debug_access(request):
+    # Profiles show code paths and timings, only for debug servers and staff
+    if not settings.DEBUG and not request.user.is_staff:
+        raise Http404
+
+
+def profiling_histogram(request):
+    # Durations of the stages recently run by this web process, and of the stages of the latest background jobs of
+    # each kind, stored with them by whichever worker ran them. See profiling.stage
+    _check_debug_access(request)
+    return JsonResponse({'process': histogram(), 'jobs': job_histogram(PROFILING_HISTORY_SIZE)})
+
+
+def profiling_report(request, report_id):
+    # cProfile report of a request sent with the profiling header, its id came back in X-Profile-Id
+    _check_debug_access(request)
+    report = profile_report(report_id)
+    if report is None:
+        raise Http404
+    return HttpResponse(report, content_type='text/plain')